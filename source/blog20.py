@@ -1,10 +1,10 @@
 #!/usr/bin/env python
 import json, datetime
-from waflib import Task, TaskGen, Errors
+from waflib import Task, TaskGen, Errors, Logs, Utils
 from waflib.Errors import WafError
 import xml.dom.minidom as minidom
 from string import Template
-import re
+import re, threading, os, shutil, filecmp
 
 MDExtensions = [
 	'markdown.extensions.codehilite',
@@ -19,7 +19,18 @@ MDExtensions_Config = {
 	}
 }
 
+def options(opt):
+	opt.add_option('--reproducible', dest='reproducible', action="store_true", default=False, help="Reproducible build: dates stamped into outputs come from SOURCE_DATE_EPOCH, content metadata or the last git commit")
+	opt.add_option('--source-date-epoch', dest='source_date_epoch', type='string', default='', help='Timestamp (seconds since epoch) stamped into outputs, the SOURCE_DATE_EPOCH environment variable takes precedence')
+	opt.add_option('--page-processes', dest='page_processes', type='int', default=0, help='Render pages (markdown, templates, indexes) in a pool of N processes instead of waf\'s threads (default: 0, disabled)')
+	opt.add_option('--no-resource-hints', dest='no_resource_hints', action="store_true", default=False, help="Don't add preload hints and lazy loading to the media of pages")
+
 def configure(conf):
+	conf.env.PAGE_PROCESSES = getattr(conf.options, 'page_processes', 0)
+	conf.env.REPRODUCIBLE = getattr(conf.options, 'reproducible', False)
+	conf.env.SOURCE_DATE_EPOCH = getattr(conf.options, 'source_date_epoch', '')
+	conf.env.RESOURCE_HINTS = not getattr(conf.options, 'no_resource_hints', False)
+
 	#find required modules
 	failed = False
 
@@ -86,6 +97,109 @@ def parse_datestr(instr):
 	else:
 		return datetime.datetime(date[0], date[1], date[2])
 
+source_date_lock = threading.Lock()
+
+def last_commit_epoch(bld):
+	import git
+	try:
+		commit = git.Repo(bld.srcnode.abspath(), search_parent_directories = True).head.commit
+	except Exception as e:
+		raise WafError('Reproducible builds need SOURCE_DATE_EPOCH or a git checkout: %s' % e)
+	return commit.committed_date
+
+def source_date(bld, content_dates = None):
+	"""
+		Date stamped into generated files (copyright year, RSS lastBuildDate):
+			* SOURCE_DATE_EPOCH (environment, then configuration) when set
+			* in reproducible builds, the latest of `content_dates`, or the date of the last git commit
+			* the current date otherwise
+	"""
+	epoch = os.environ.get('SOURCE_DATE_EPOCH', bld.env.SOURCE_DATE_EPOCH)
+	if epoch:
+		return datetime.datetime.fromtimestamp(int(epoch), datetime.timezone.utc).replace(tzinfo = None)
+
+	if not bld.env.REPRODUCIBLE:
+		return datetime.datetime.now()
+
+	if content_dates:
+		return max(content_dates)
+
+	with source_date_lock:
+		if getattr(bld, 'commit_epoch', None) == None:
+			bld.commit_epoch = last_commit_epoch(bld)
+	return datetime.datetime.fromtimestamp(bld.commit_epoch, datetime.timezone.utc).replace(tzinfo = None)
+
+def write_if_changed(node, data, encoding = 'latin-1'):
+	"""
+		Writes a generated file only when its content changed: unchanged files keep
+		their modification time, so deploy syncs only see real differences
+	"""
+	if isinstance(data, str):
+		data = data.encode(encoding)
+	path = node.abspath()
+	try:
+		if os.path.getsize(path) == len(data):
+			with open(path, 'rb') as f:
+				if f.read() == data:
+					return False
+	except OSError:
+		pass
+	node.write(data, 'wb')
+	return True
+
+def copy_if_changed(src, dst):
+	if os.path.isdir(dst):
+		dst = os.path.join(dst, os.path.basename(src))
+	if os.path.exists(dst) and filecmp.cmp(src, dst, shallow = False):
+		return False
+	shutil.copyfile(src, dst)
+	shutil.copymode(src, dst)
+	return True
+
+def fork_context():
+	"""
+		Returns the fork multiprocessing context, or None where processes can't be forked (Windows):
+		callers then do the work in the current process
+	"""
+	import multiprocessing
+	if 'fork' not in multiprocessing.get_all_start_methods():
+		return None
+	return multiprocessing.get_context('fork')
+
+def setup(bld):
+	bld.add_pre_fun(start_page_pool)
+
+def start_page_pool(bld):
+	"""
+		Process pool for the pure python work of page tasks, the GIL serializes it in waf's threads.
+		Workers are forked, so this runs as a pre-build function: the envs are loaded by then,
+		and bld.compile() hasn't started waf's runner threads yet.
+	"""
+	if not bld.env.PAGE_PROCESSES:
+		return
+	context = fork_context()
+	if context == None:
+		Logs.warn('--page-processes needs fork, pages are rendered in waf\'s threads')
+		return
+	import concurrent.futures
+	bld.page_pool = concurrent.futures.ProcessPoolExecutor(
+		max_workers = bld.env.PAGE_PROCESSES,
+		mp_context = context
+	)
+	#with fork, the first job starts all the workers
+	bld.page_pool.submit(int).result()
+	bld.add_post_fun(lambda bld: bld.page_pool.shutdown())
+
+def run_page_job(tsk, fun, *args):
+	"""
+		Runs fun(*args) in the page process pool if enabled, or in the current thread.
+		Arguments and results must be picklable: text, metadata, paths and env values.
+	"""
+	pool = getattr(tsk.generator.bld, 'page_pool', None)
+	if pool == None:
+		return fun(*args)
+	return pool.submit(fun, *args).result()
+
 @TaskGen.taskgen_method
 def get_static_dir_root(self):
 	return self.bld.bldnode.find_or_declare('static')
@@ -98,18 +212,63 @@ def get_static_dir(self):
 			self.static_dir = self.static_dir.find_or_declare(self.static_root)
 	return self.static_dir
 
+@TaskGen.taskgen_method
+def get_page_template(self):
+	"""
+		Returns the template node used to generate pages,
+		replaced by its bundled version when the blog20_assets tool is loaded
+	"""
+	tpl = self.to_nodes(self.to_list(getattr(self, 'template', self.bld.root.find_node(self.env['tpl_main']))))[0]
+	if self.env.HAS_BLOG20_ASSETS:
+		tpl = self.get_bundled_template(tpl)
+	return tpl
+
+@TaskGen.taskgen_method
+def publish_page(self, srcnode, outnode):
+	"""
+		Copies a generated page into the static directory,
+		post-processing it when the blog20_assets tool is loaded
+	"""
+	if self.env.HAS_BLOG20_ASSETS:
+		tsk = self.create_critical_css_task(srcnode, outnode)
+		if tsk != None:
+			return tsk
+	return self.create_task('CopyFiles', [srcnode], [outnode])
+
+@TaskGen.taskgen_method
+def override_static_copy(self, srcnode, newnode):
+	"""
+		Publishes the generated `newnode` in place of the source file `srcnode`
+		wherever a copyfiles task generator copies it, whether it was posted before or after
+	"""
+	self.bld.static_overrides = getattr(self.bld, 'static_overrides', {})
+	self.bld.static_overrides[srcnode] = newnode
+	for group in self.bld.groups:
+		for tg in group:
+			for tsk in getattr(tg, 'tasks', []):
+				apply_static_override(tsk)
+
+def apply_static_override(tsk):
+	if tsk.__class__.__name__ != 'CopyFiles':
+		return
+	newnode = getattr(tsk.generator.bld, 'static_overrides', {}).get(tsk.inputs[0], None)
+	if newnode != None and newnode not in tsk.inputs:
+		#as an input, the copy waits for newnode and is redone when it changes
+		tsk.inputs.append(newnode)
+		tsk.override = newnode
+
 @TaskGen.feature("index")
 @TaskGen.after_method("process_source", "proc_series")
 def proc_index(self):
 	self.get_static_dir()
-	tpl = self.to_nodes(self.to_list(getattr(self, 'template', self.bld.root.find_node(self.env['tpl_main']))))[0]
+	tpl = self.get_page_template()
 	navmenu = getattr(self, 'navmenu', self.env.NavMenu)
 	self.index_page = self.static_dir.find_or_declare(self.target).find_or_declare("index.html")
 	tmpdir = self.path.find_or_declare("tmp/index")
 	tmpdir.mkdir()
 	tmpnode = tmpdir.find_or_declare(self.target + '.html')
 	tsk = self.create_task('GenerateIndex', self.source, [tmpnode])
-	tsk.node_deps = [tpl]
+	tsk.dep_nodes.append(tpl)
 	tsk.index_root_src = self.path
 	tsk.template = tpl
 	tsk.navmenu = navmenu
@@ -129,7 +288,7 @@ def proc_index(self):
 		self.custom_index_mdt = self.create_task('BuildMdContent', [mdIdx], [self.custom_index_html])
 		tsk.inputs.append(mdIdx)
 
-	self.create_task('CopyFiles', tsk.outputs, [self.index_page])
+	self.publish_page(tsk.outputs[0], self.index_page)
 
 @TaskGen.feature("copyfiles")
 def proc_copyfiles(self):
@@ -137,13 +296,13 @@ def proc_copyfiles(self):
 	self.static_dir = self.get_static_dir()
 	for file in self.copyfiles:
 		outnode = self.static_dir.find_or_declare(self.target).find_or_declare(file.get_src().path_from(self.path))
-		self.create_task('CopyFiles', [file], [outnode])
+		apply_static_override(self.create_task('CopyFiles', [file], [outnode]))
 
 @TaskGen.feature("page_template")
 @TaskGen.after_method("process_source")
 @TaskGen.after_method("proc_index")
 def proc_ptemplate(self):
-	tpl = self.to_nodes(self.to_list(getattr(self, 'template', self.bld.root.find_node(self.env['tpl_main']))))[0]
+	tpl = self.get_page_template()
 	navmenu = getattr(self, 'navmenu', self.env.NavMenu)
 	self.mdout = getattr(self, 'mdout', [])
 	for md in self.mdout:
@@ -155,26 +314,68 @@ def proc_ptemplate(self):
 		tsk = self.create_task('GeneratePageTemplate', [md.outputs[0]], [md.outputs[0].change_ext('_compiled.html')])
 		tsk.mdt = md
 		tsk.template = tpl
+		tsk.dep_nodes.append(tpl)
 		tsk.navmenu = navmenu
 
-		if getattr(self, "series_meta", None) != None:
-			meta = self.series_meta[md.inputs[0].abspath()]
-			meta_prev = meta["prev"]
-			meta_next = meta["next"]
-
-			if meta_prev != None:
-				n_prev = [m for m in self.mdout if m.inputs[0] == meta_prev][0]
-			else:
-				n_prev = None
+		if getattr(self, "series_graph", None) != None:
+			node = md.inputs[0]
+			tsk.series = [self.series_graph.prev_task(node), self.series_graph.next_task(node)]
 
-			if meta_next != None:
-				n_next = [m for m in self.mdout if m.inputs[0] == meta_next][0]
-			else:
-				n_next = None
+		self.publish_page(tsk.outputs[0], outnode)
 
-			tsk.series = [n_prev, n_next]
-
-		self.create_task('CopyFiles', [tsk.outputs[0]], [outnode])
+class SeriesGraph(object):
+	"""
+		Pages of a series in reading order and their nesting, as given by the tab-indented `pages` list.
+		Pages are looked up by node path, the BuildMdContent task of each page is registered by proc_markdown.
+	"""
+	def __init__(self, target):
+		self.target = target
+		self.nodes = []
+		self.indents = []
+		self.parents = []
+		self.children = [[]] #children[0] are the top level pages, children[i + 1] are the children of page i
+		self.positions = {}
+		self.tasks = {}
+
+	def add(self, node, indent):
+		pos = len(self.nodes)
+		#parent: closest previous page with a lower indent
+		parent = pos - 1
+		while parent >= 0 and self.indents[parent] >= indent:
+			parent = self.parents[parent] if self.parents[parent] != None else -1
+		parent = parent if parent >= 0 else None
+
+		self.nodes.append(node)
+		self.indents.append(indent)
+		self.parents.append(parent)
+		self.children.append([])
+		self.children[0 if parent == None else parent + 1].append(pos)
+		self.positions[node.abspath()] = pos
+
+	def set_task(self, node, tsk):
+		if node.abspath() in self.positions:
+			self.tasks[self.positions[node.abspath()]] = tsk
+
+	def position(self, node):
+		return self.positions[node.abspath()]
+
+	def indent(self, node):
+		return self.indents[self.position(node)]
+
+	def prev_task(self, node):
+		pos = self.position(node)
+		return self.tasks[pos - 1] if pos > 0 else None
+
+	def next_task(self, node):
+		pos = self.position(node)
+		return self.tasks[pos + 1] if pos + 1 < len(self.nodes) else None
+
+	def toc(self, pos = None):
+		"""
+			Nested table of contents: a list of (BuildMdContent task, indent, [children]) tuples
+		"""
+		children = self.children[0 if pos == None else pos + 1]
+		return [(self.tasks[c], self.indents[c], self.toc(c)) for c in children]
 
 @TaskGen.feature("series")
 @TaskGen.before_method("process_source")
@@ -183,13 +384,7 @@ def proc_series(self):
 	pages = self.to_list(getattr(self, 'pages', []))
 
 	indent_level = 0
-	self.series_meta = {
-		'@meta': {
-			'target': self.target,
-			#...
-		}
-	}
-	last = None
+	self.series_graph = SeriesGraph(self.target)
 	for page in pages:
 		sp = page.split('\t')
 		if len(sp) - 1 > indent_level:
@@ -199,16 +394,7 @@ def proc_series(self):
 
 		node = self.to_nodes(sp[len(sp)-1])[0]
 		self.source.append(node)
-
-		self.series_meta[node.abspath()] = {
-			'indent': indent_level,
-			'prev': last,
-			'next': None
-		}
-
-		if last != None:
-			self.series_meta[last.abspath()]['next'] = node
-		last = node
+		self.series_graph.add(node, indent_level)
 
 @TaskGen.feature("pygmentize")
 def proc_pygmentize(self):
@@ -222,6 +408,8 @@ def proc_markdown(self, node):
 	tsk = self.create_task('BuildMdContent', [node], [outnode])
 	self.mdout = getattr(self, 'mdout', [])
 	self.mdout.append(tsk)
+	if getattr(self, 'series_graph', None) != None:
+		self.series_graph.set_task(node, tsk)
 
 @TaskGen.feature("modelviewer")
 @TaskGen.before("process_source")
@@ -281,7 +469,12 @@ class CopyFiles(Task.Task):
 			outnode = procdir.find_or_declare(self.inputs[0].name)
 			outnode.write(processed)
 			self.inputs = [outnode]
-		self.exec_command(['cp', '-r', self.inputs[0].abspath(), self.outputs[0].abspath()])
+		if getattr(self, 'override', None) != None:
+			copy_if_changed(self.override.abspath(), self.outputs[0].abspath())
+		elif os.path.isdir(self.inputs[0].abspath()):
+			self.exec_command(['cp', '-r', self.inputs[0].abspath(), self.outputs[0].abspath()])
+		else:
+			copy_if_changed(self.inputs[0].abspath(), self.outputs[0].abspath())
 
 class Pygmentize(Task.Task):
 	#always_run = True
@@ -306,7 +499,47 @@ class Pygmentize(Task.Task):
 			css = pygments.formatters.HtmlFormatter(style = styles[scheme]).get_style_defs(['.codehilite','.codehilitetable'])
 			out_css += "@media(prefers-color-scheme: %s){\n%s\n}\n" % (scheme, css)
 		self.outputs[0].parent.mkdir()
-		self.outputs[0].write(out_css)
+		write_if_changed(self.outputs[0], out_css)
+
+def apply_image_replacements(src, replacements):
+	for (original_rel, new_rel) in replacements:
+		src = re.sub(
+			"!\\[(.*)\\]\\(%s\\)" % original_rel,
+			"![\\1](%s)" % new_rel,
+			src
+		)
+
+		src = re.sub(
+			"src[ ?]*=[ ?]*\"%s\"" % original_rel,
+			"src=\"%s\"" % new_rel,
+			src
+		)
+	return src
+
+def render_markdown(md, meta, replacements, date_format):
+	"""
+		Compiles a markdown document (without its metadata header) to html
+	"""
+	from markdown import markdown
+
+	md = apply_image_replacements(md, replacements)
+
+	header = ""
+	footer = ""
+
+	if "title" in meta:
+		header += '# %s\n' % meta['title']
+
+	if "date" in meta:
+		header += '<p class="article-date">%s</p>\n' % parse_datestr(meta["date"]).strftime(date_format)
+
+	return '<span>%s</span>' % (
+		markdown(
+			text = '%s\n%s\n%s' % (header, md, footer),
+			extensions = MDExtensions,
+			extensions_config = MDExtensions_Config
+		)
+	)
 
 class BuildMdContent(Task.Task):
 	"""
@@ -315,34 +548,16 @@ class BuildMdContent(Task.Task):
 	def run(self):
 		self.meta = {}
 
-		import markdown
-		from markdown import markdown
 		self.outputs[0].parent.mkdir()
 		
 		(self.meta, md) = extract_meta_header(self.inputs[0])
 
+		replacements = []
 		if getattr(self.env, 'img_replacement_map', None) != None:
-			md = self.update_images(md, self.env.img_replacement_map)
-
-		header = ""
-		footer = ""
+			replacements = self.image_replacements(self.env.img_replacement_map)
 
-		if "title" in self.meta:
-			header += '# %s\n' % self.meta['title']
-
-		if "date" in self.meta:
-			header += '<p class="article-date">%s</p>\n' % parse_datestr(self.meta["date"]).strftime(self.env.DATE_FORMAT_STRING)
-
-		html = '<span>%s</span>' % (
-			markdown(
-				text = '%s\n%s\n%s' % (header, md, footer),
-				output = self.outputs[0].abspath(),
-				extensions = MDExtensions,
-				extensions_config = MDExtensions_Config
-			)
-		)
-
-		self.outputs[0].write(html, encoding = "utf-8")
+		html = run_page_job(self, render_markdown, md, self.meta, replacements, self.env.DATE_FORMAT_STRING)
+		write_if_changed(self.outputs[0], html, encoding = "utf-8")
 
 	def runnable_status(self):
 		ret = super().runnable_status()
@@ -350,8 +565,16 @@ class BuildMdContent(Task.Task):
 			(self.meta, _) = extract_meta_header(self.inputs[0])
 		return ret
 
-	def update_images(self, src, replacements):
-		for original in replacements.keys():
+	def restore_from_cache(self):
+		#outputs were downloaded from the build cache (blog20_cache), only the metadata is missing
+		(self.meta, _) = extract_meta_header(self.inputs[0])
+
+	def image_replacements(self, replacements):
+		"""
+			Converts the replacement map (absolute paths) to paths relative to the task generator
+		"""
+		ret = []
+		for original in sorted(replacements.keys()):
 			new = replacements[original]
 
 			original_node = self.generator.bld.root.find_node(original)
@@ -359,19 +582,11 @@ class BuildMdContent(Task.Task):
 
 			original_rel = original_node.path_from(self.generator.path).replace('\\', '/')
 			new_rel = new_node.get_src().path_from(self.generator.path).replace('\\', '/')
+			ret.append((original_rel, new_rel))
+		return ret
 
-			src = re.sub(
-				"!\\[(.*)\\]\\(%s\\)" % original_rel,
-				"![\\1](%s)" % new_rel,
-				src
-			)
-
-			src = re.sub(
-				"src[ ?]*=[ ?]*\"%s\"" % original_rel,
-				"src=\"%s\"" % new_rel,
-				src
-			)
-		return src
+	def update_images(self, src, replacements):
+		return apply_image_replacements(src, BuildMdContent.image_replacements(self, replacements))
 
 def format_title(title, limit = 0):
 	ret = title.replace('-', ' ').replace('\\ ', '-')
@@ -386,14 +601,21 @@ def genGetIdDict(dom):
 		elms[e.getAttribute("id")] = e
 	return elms
 
-def genCopyright(gen, dom, elm):
-	year = datetime.date.today().year
+def copyrightText(gen):
+	year = source_date(gen.bld).year
+	return gen.env.COPYRIGHT_STRING % year
+
+def genCopyright(dom, elm, text):
 	copyright = dom.createElement('p')
 	copyright.setAttribute('class', 'copyright')
-	copyright.appendChild(dom.createTextNode(gen.env.COPYRIGHT_STRING % year))
+	copyright.appendChild(dom.createTextNode(text))
 	elm.appendChild(copyright)
 
-def genNavMenu(gen, dom, elmMenu, navmenu):
+def navMenuLinks(gen, navmenu):
+	"""
+		Resolves the nav menu items to (label, href) tuples
+	"""
+	links = []
 	for item in navmenu:
 		if isinstance(item, tuple):
 			href = item[1]
@@ -404,17 +626,25 @@ def genNavMenu(gen, dom, elmMenu, navmenu):
 				href = '/'+item
 			except WafError:
 				href = '#'
+		links.append((item, str(href)))
+	return links
+
+def genNavMenu(dom, elmMenu, links):
+	for (item, href) in links:
 		elm = dom.createElement('li')
 
 		anchor = dom.createElement('a')
 		anchor.setAttribute('class', 'menu-item')
-		anchor.setAttribute('href', str(href))
+		anchor.setAttribute('href', href)
 		anchor.appendChild(dom.createTextNode(item))
 		elm.appendChild(anchor)
 
 		elmMenu.appendChild(elm)
 
-def genOpenGraph(self, dom, mdt, title, urlpath = None):
+def openGraphProps(self, mdt, title, urlpath = None):
+	"""
+		Returns the (property, content) OpenGraph tags of a page
+	"""
 
 	if "og:title" in mdt.meta:
 		opengraph = [("og:title", mdt.meta['og:title'])]
@@ -446,15 +676,185 @@ def genOpenGraph(self, dom, mdt, title, urlpath = None):
 		)
 		opengraph.append(("og:url", calculated_url))
 
+	return [(str(og[0]), str(og[1])) for og in opengraph]
+
+def genOpenGraph(dom, opengraph):
 	head = dom.getElementsByTagName('head')
 	for og in opengraph:
 		tag = dom.createElement('meta')
-		tag.setAttribute("property", str(og[0]))
-		tag.setAttribute("content", str(og[1]))
+		tag.setAttribute("property", og[0])
+		tag.setAttribute("content", og[1])
 		head[0].appendChild(tag)
 
+def service_worker_url(bld):
+	"""
+		Url of the service worker pages register, or None when the build has no
+		service_worker task generator to write it (or it was configured out)
+	"""
+	if not bld.env.SERVICE_WORKER:
+		return None
+	for g in bld.groups:
+		for tg in g:
+			if 'service_worker' in Utils.to_list(getattr(tg, 'features', [])):
+				return bld.env.SERVICE_WORKER
+	return None
+
+def genServiceWorker(dom, url):
+	script = dom.createElement('script')
+	script.appendChild(dom.createTextNode("if('serviceWorker' in navigator){navigator.serviceWorker.register('%s');}" % url))
+	dom.getElementsByTagName('body')[0].appendChild(script)
+
+def render_index(template_path, index_src, title_str, navmenu, opengraph, copyright, service_worker = None):
+	"""
+		Assembles an index page from the main template and the substituted index template
+	"""
+	domTpl = minidom.parse(template_path)
+	elms = genGetIdDict(domTpl)
+
+	genOpenGraph(domTpl, opengraph)
+
+	domIndex = minidom.parseString(index_src)
+	elms['MainContent'].appendChild(domIndex.firstChild)
+
+	title = domTpl.getElementsByTagName("title")[0]
+	title.removeChild(title.firstChild)
+	title.appendChild(domTpl.createTextNode(title_str))
+
+	genNavMenu(domTpl, elms["NavMenu"], navmenu)
+	if "CopyrightString" in elms:
+		genCopyright(domTpl, elms["CopyrightString"], copyright)
+	if service_worker:
+		genServiceWorker(domTpl, service_worker)
+
+	return domTpl.toxml()
+
+#media that can be the hero of a page must be in its first blocks and not explicitly smaller than this
+HERO_MAX_BLOCK = 3
+HERO_MIN_SIZE = 200
+
+#secondary models get their src from data-src on first interaction
+MODEL_ON_INTERACTION_JS = "document.querySelectorAll('model-viewer[data-src]').forEach(function(mv){var load=function(){if(!mv.getAttribute('src')){mv.setAttribute('src',mv.getAttribute('data-src'));}};['pointerdown','focus','keydown'].forEach(function(e){mv.addEventListener(e,load,{once:true});});});"
+
+def is_hero_candidate(elm):
+	if elm.tagName == 'model-viewer':
+		return elm.getAttribute('src') != ''
+	src = elm.getAttribute('src').split('?')[0].lower()
+	if src == '' or src.endswith('.svg') or src.endswith('.gif'):
+		return False
+	for dim in ['width', 'height']:
+		value = elm.getAttribute(dim)
+		if value.isdigit() and int(value) < HERO_MIN_SIZE:
+			return False
+	return True
+
+def genResourceHints(dom, content):
+	"""
+		Classifies the media of the page content by position and size:
+		the first large image or model in the first blocks is the hero and is preloaded,
+		other images are lazy loaded and decoded asynchronously,
+		other models are only downloaded once the visitor interacts with them.
+		Loading attributes written by hand are kept.
+	"""
+	blocks = [c for c in content.childNodes if c.nodeType == c.ELEMENT_NODE]
+	#skip the title and date render_markdown puts before the content
+	if len(blocks) > 0 and blocks[0].tagName == 'h1':
+		blocks = blocks[1:]
+	if len(blocks) > 0 and blocks[0].tagName == 'p' and 'article-date' in blocks[0].getAttribute('class').split():
+		blocks = blocks[1:]
+
+	media = []
+	for (block, child) in enumerate(blocks):
+		if child.tagName in ['img', 'model-viewer']:
+			found = [child]
+		else:
+			found = [e for e in child.getElementsByTagName('*') if e.tagName in ['img', 'model-viewer']]
+		media.extend([(block, e) for e in found])
+
+	hero = None
+	for (block, elm) in media:
+		if block < HERO_MAX_BLOCK and is_hero_candidate(elm):
+			hero = elm
+			break
+
+	deferred_models = False
+	for (block, elm) in media:
+		if elm is hero:
+			if elm.tagName == 'img':
+				elm.setAttribute('fetchpriority', 'high')
+			if not elm.hasAttribute('loading'):
+				elm.setAttribute('loading', 'eager')
+		elif elm.tagName == 'img':
+			if not elm.hasAttribute('loading'):
+				elm.setAttribute('loading', 'lazy')
+			if not elm.hasAttribute('decoding'):
+				elm.setAttribute('decoding', 'async')
+		elif not elm.hasAttribute('loading') and elm.getAttribute('src') != '':
+			elm.setAttribute('data-src', elm.getAttribute('src'))
+			elm.removeAttribute('src')
+			elm.setAttribute('loading', 'lazy')
+			deferred_models = True
+
+	if hero != None:
+		link = dom.createElement('link')
+		link.setAttribute('rel', 'preload')
+		link.setAttribute('href', hero.getAttribute('src'))
+		if hero.tagName == 'img':
+			link.setAttribute('as', 'image')
+			link.setAttribute('fetchpriority', 'high')
+			if hero.hasAttribute('srcset'):
+				link.setAttribute('imagesrcset', hero.getAttribute('srcset'))
+				if hero.getAttribute('sizes'):
+					link.setAttribute('imagesizes', hero.getAttribute('sizes'))
+		else:
+			#model-viewer fetches models in cors mode
+			link.setAttribute('as', 'fetch')
+			link.setAttribute('crossorigin', 'anonymous')
+		head = dom.getElementsByTagName('head')[0]
+		links = head.getElementsByTagName('link')
+		if len(links) > 0:
+			links[0].parentNode.insertBefore(link, links[0])
+		else:
+			head.appendChild(link)
+
+	if deferred_models:
+		script = dom.createElement('script')
+		script.appendChild(dom.createTextNode(MODEL_ON_INTERACTION_JS))
+		dom.getElementsByTagName('body')[0].appendChild(script)
+
+def render_page(template_path, content_path, title_str, navmenu, opengraph, series_nav, copyright, resource_hints = False, service_worker = None):
+	"""
+		Assembles a page from the main template and a compiled markdown document
+	"""
+	domTpl = minidom.parse(template_path)
+	domInput = minidom.parse(content_path)
+	elms = genGetIdDict(domTpl)
+	elms["MainContent"].appendChild(domInput.firstChild)
+	if resource_hints:
+		genResourceHints(domTpl, elms["MainContent"].lastChild)
+
+	title = domTpl.getElementsByTagName("title")[0]
+	title.removeChild(title.firstChild)
+	title.appendChild(domTpl.createTextNode(title_str))
+
+	genNavMenu(domTpl, elms["NavMenu"], navmenu)
+	genOpenGraph(domTpl, opengraph)
+
+	if series_nav != None:
+		dom = minidom.parseString(series_nav)
+		elms["MainContent"].appendChild(dom.firstChild)
+
+	if "CopyrightString" in elms:
+		genCopyright(domTpl, elms["CopyrightString"], copyright)
+	if service_worker:
+		genServiceWorker(domTpl, service_worker)
+	return domTpl.toxml()
+
 class GenerateIndex(Task.Task):
 	after = ['GeneratePageTemplate', 'BuildMdContent']
+	def sig_vars(self):
+		#the copyright year and the service worker registration are stamped into the index
+		Task.Task.sig_vars(self)
+		self.m.update(repr((copyrightText(self.generator), service_worker_url(self.generator.bld))).encode('utf-8'))
 	def run(self):
 		tplIndex = Template(self.generator.bld.root.find_node(self.env['tpl_index']).read(encoding = "utf-8"))
 
@@ -467,20 +867,23 @@ class GenerateIndex(Task.Task):
 
 		tplIndexItemSeries = Template(self.generator.bld.root.find_node(self.env['tpl_index_item_series']).read(encoding = "utf-8"))
 
-		domTpl = minidom.parse(self.template.abspath())
-		elms = genGetIdDict(domTpl)
+		opengraph = []
 		outlinks = []
 		mdout_list = self.generator.mdout
 
 		index_root = self.generator.index_page
 
+		atlas = {}
+		if getattr(self.generator, 'atlas_map', None) != None:
+			atlas = json.loads(self.generator.atlas_map.read(encoding = 'utf-8'))
+
 		#collect outlinks from `use` attribute
 		uselist = self.generator.to_list(getattr(self.generator, 'use', []))
 		for usename in uselist:
 			try:
 				tg = self.generator.bld.get_tgen_by_name(usename)
-				if getattr(tg, 'series_meta', None) != None:
-					mdout_list.append((tg.series_meta, tg.mdout))
+				if getattr(tg, 'series_graph', None) != None:
+					mdout_list.append((tg.series_graph, tg.mdout))
 				elif getattr(tg, 'mdout', None) != None:
 					mdout_list.extend(tg.mdout)
 			except WafError:
@@ -492,9 +895,9 @@ class GenerateIndex(Task.Task):
 				raise WafError("MDT has no meta: %s" % mdt.inputs[0])
 
 			subdict = mdt.meta.copy()
+			subdict['extra'] = ""
 			if update != None:
 				subdict.update(update)
-			subdict['extra'] = ""
 			subdict['extra_classes'] = " ".join(extra_classes)
 			if 'title' not in subdict:
 				subdict['title'] = mdt.inputs[0].change_ext('').name
@@ -509,23 +912,39 @@ class GenerateIndex(Task.Task):
 
 			ti_substr = tplIndexItem.substitute(subdict)
 
+			tile = mdt.meta.get(getattr(self.generator, 'atlas_field', 'tile'), None)
+			if tile in atlas:
+				from blog20_media import ATLAS_PLACEHOLDER, atlas_img_style
+				ti_substr = re.sub('<img src="%s"' % re.escape(tile),
+					lambda m: '<img src="%s" style="%s"' % (ATLAS_PLACEHOLDER, atlas_img_style(atlas[tile])),
+					ti_substr)
+
 			if getattr(self.env, 'img_replacement_map', None) != None:
 				ti_substr = BuildMdContent.update_images(self, ti_substr, self.env.img_replacement_map)
 
 			return (ti_substr, date)
 
+		def buildTocItems(toc):
+			items = []
+			for (m, indent, children) in toc:
+				extra = ''
+				if len(children) > 0:
+					extra = '<ul class="series-toc">%s</ul>' % '\n'.join(buildTocItems(children))
+				items.append(buildIndexItem(m, {'extra': extra}, ['indent-%s' % indent])[0])
+			return items
+
 		for mdt in mdout_list:
 			if isinstance(mdt, tuple):
 				#Series index item
-				series_meta = mdt[0]
+				series_graph = mdt[0]
 				mdout = mdt[1]
 
-				title_str = format_title(series_meta['@meta']['target'])
+				title_str = format_title(series_graph.target)
 
 				items = []
 				latest_date = None
 				for m in mdout:
-					indent = ['indent-%s' % series_meta[m.inputs[0].abspath()]['indent']]
+					indent = ['indent-%s' % series_graph.indent(m.inputs[0])]
 					item = buildIndexItem(m, None, indent)
 					items.append(item[0])
 
@@ -535,7 +954,7 @@ class GenerateIndex(Task.Task):
 				#Series index item
 				src = tplIndexItemSeries.substitute({
 					'title': '%s (%s)' % (title_str, len(mdout)),
-					'href': series_meta['@meta']['target'],
+					'href': series_graph.target,
 					'date': '',
 					'series_items': '\n'.join(items)
 				})
@@ -547,13 +966,19 @@ class GenerateIndex(Task.Task):
 
 		oldest = datetime.datetime(1995, 7, 14)
 		def keyfunc(t):
+			#items with the same date are ordered by their markup
 			if t[1] != None:
-				return t[1]
-			return oldest
+				return (t[1], t[0])
+			return (oldest, t[0])
 		outlinks.sort(key=keyfunc, reverse=True)
 
+		if getattr(self.generator, 'series_graph', None) != None:
+			#a series' own index is its table of contents, in reading order
+			items_str = '<ul class="series-toc">%s</ul>' % '\n'.join(buildTocItems(self.generator.series_graph.toc()))
+		else:
+			items_str = '\n'.join([l[0] for l in outlinks])
+
 		#series includes a custom index
-		items_str = '\n'.join([l[0] for l in outlinks])
 		if getattr(self.generator, 'custom_index_html', None) != None:
 			idxSrc = self.generator.custom_index_html.read(encoding = "utf-8")
 			items_str = Template(idxSrc).substitute({
@@ -565,37 +990,33 @@ class GenerateIndex(Task.Task):
 			else:
 				title_str = format_title(self.generator.target)
 			urlpath = index_root.parent.path_from(self.generator.get_static_dir_root())
-			genOpenGraph(self, domTpl, self.generator.custom_index_mdt, title_str, urlpath)
+			opengraph = openGraphProps(self, self.generator.custom_index_mdt, title_str, urlpath)
 
 		subdict = {
 			'title': format_title(self.generator.target),
 			'items': items_str
 		}
-		domIndex = minidom.parseString(tplIndex.substitute(subdict))
-		elms['MainContent'].appendChild(domIndex.firstChild)
-
-		title = domTpl.getElementsByTagName("title")[0]
-		title.removeChild(title.firstChild)
-		title.appendChild(domTpl.createTextNode(subdict['title']))
 
-		genNavMenu(self.generator, domTpl, elms["NavMenu"], self.navmenu)
-		if "CopyrightString" in elms:
-			genCopyright(self.generator, domTpl, elms["CopyrightString"])
-
-		xml_out = domTpl.toxml()
-		self.outputs[0].write(xml_out, encoding = "utf-8")
+		xml_out = run_page_job(self, render_index,
+			self.template.abspath(),
+			tplIndex.substitute(subdict),
+			subdict['title'],
+			navMenuLinks(self.generator, self.navmenu),
+			opengraph,
+			copyrightText(self.generator),
+			service_worker_url(self.generator.bld)
+		)
+		write_if_changed(self.outputs[0], xml_out, encoding = "utf-8")
 
 
 class GeneratePageTemplate(Task.Task):
 	after = ['BuildMdContent']
+	vars = ['RESOURCE_HINTS']
+	def sig_vars(self):
+		#the copyright year and the service worker registration are stamped into the page
+		Task.Task.sig_vars(self)
+		self.m.update(repr((copyrightText(self.generator), service_worker_url(self.generator.bld))).encode('utf-8'))
 	def run(self):
-		domTpl = minidom.parse(self.template.abspath())
-		domInput = minidom.parse(self.inputs[0].abspath())
-		elms = genGetIdDict(domTpl)
-		elms["MainContent"].appendChild(domInput.firstChild)
-
-		title = domTpl.getElementsByTagName("title")[0]
-
 		if 'title' in self.mdt.meta:
 			title_str = format_title(self.mdt.meta['title'])
 		else:
@@ -608,12 +1029,7 @@ class GeneratePageTemplate(Task.Task):
 			else:
 				return t.inputs[0].change_ext('')
 
-		title.removeChild(title.firstChild)
-		title.appendChild(domTpl.createTextNode(title_str))
-
-		genNavMenu(self.generator, domTpl, elms["NavMenu"], self.navmenu)
-		genOpenGraph(self, domTpl, self.mdt, get_title(self.mdt))
-
+		series_nav = None
 		if getattr(self, 'series', None) != None:
 
 			if self.series[0] != None:
@@ -639,23 +1055,35 @@ class GeneratePageTemplate(Task.Task):
 			series_title = format_title(self.generator.target, max_title_len)
 
 			tplSeriesNav = Template(self.generator.bld.root.find_node(self.env['tpl_series_nav']).read(encoding = "utf-8"))
-			dom = minidom.parseString(tplSeriesNav.substitute({
+			series_nav = tplSeriesNav.substitute({
 				'href_prev'		: href_prev,
 				'title_prev'	: prev_title,
 				'href_next'		: href_next,
 				'title_next'	: next_title,
 				'href_root'		: "index.html",
 				'title_root'	: series_title,
-			}))
-			elms["MainContent"].appendChild(dom.firstChild)
-		
-		if "CopyrightString" in elms:
-			genCopyright(self.generator, domTpl, elms["CopyrightString"])
-		xml_out = domTpl.toxml()
-		self.outputs[0].write(xml_out, encoding = "utf-8")
+			})
+
+		xml_out = run_page_job(self, render_page,
+			self.template.abspath(),
+			self.inputs[0].abspath(),
+			title_str,
+			navMenuLinks(self.generator, self.navmenu),
+			openGraphProps(self, self.mdt, get_title(self.mdt)),
+			series_nav,
+			copyrightText(self.generator),
+			bool(self.env.RESOURCE_HINTS),
+			service_worker_url(self.generator.bld)
+		)
+		write_if_changed(self.outputs[0], xml_out, encoding = "utf-8")
 
 class GenerateRSSChannel(Task.Task):
 	after = ['BuildMdContent']
+	vars = ['REPRODUCIBLE']
+	def sig_vars(self):
+		#lastBuildDate comes from SOURCE_DATE_EPOCH when set, else from the items
+		Task.Task.sig_vars(self)
+		self.m.update(str(os.environ.get('SOURCE_DATE_EPOCH', self.env.SOURCE_DATE_EPOCH)).encode('utf-8'))
 	def run(self):
 		import rfeed		
 		feed_items = []
@@ -681,11 +1109,11 @@ class GenerateRSSChannel(Task.Task):
 			image = img,
 			description = self.channel_info['description'],
 			language = getattr(self.channel_info, "language", "en-US"),
-			lastBuildDate = datetime.datetime.now(),
+			lastBuildDate = source_date(self.generator.bld, [i.pubDate for i in feed_items]),
 			items = feed_items
 		)
 
-		self.outputs[0].write(channel.rss())
+		write_if_changed(self.outputs[0], channel.rss())
 
 	def build_feed_item(self, item):
 		import rfeed
@@ -776,7 +1204,7 @@ class ModelViewerPreproc(Task.Task):
 				expansions.append(ex)
 				mdsrc_out = re.sub(match.group(0), ex, mdsrc_out)
 
-		node_out.write(mdsrc_out, encoding='utf-8')
+		write_if_changed(node_out, mdsrc_out, encoding='utf-8')
 
 	def expand(self, match):
 		import yaml
@@ -793,7 +1221,7 @@ class ModelViewerPreproc(Task.Task):
 
 		out_attribs = []
 		
-		for key in attribs.keys():
+		for key in sorted(attribs.keys()):
 			value = str(attribs[key])
 			out_attribs.append('%s=\"%s\"'%(key, value))
 		
@@ -0,0 +1,763 @@
+#!/usr/bin/env python
+#asset pipeline tools (stylesheets, fonts, scripts)
+
+from waflib import Task, TaskGen, Utils
+from waflib.Errors import WafError
+from blog20 import write_if_changed, copy_if_changed
+import xml.dom.minidom as minidom
+import re, os, json
+
+CSS_COMMENT = re.compile(r'/\*.*?\*/', re.DOTALL)
+CSS_IMPORT = re.compile(r'''@import\s+(?:url\()?\s*['"]?([^'")\s]+)['"]?\s*\)?\s*([^;]*);''', re.IGNORECASE)
+CSS_GROUP_RULES = ['@media', '@supports', '@document', '@-moz-document', '@layer']
+
+#elements (in document order) considered to be above the fold
+CRITICAL_ELEMENTS = 40
+#subtrees never considered to be above the fold
+CRITICAL_SKIP_IDS = ['menu', 'footer']
+
+#glyphs are referenced through escapes in the private use area, e.g. content:"\f099"
+CSS_GLYPH = re.compile(r'''content\s*:\s*['"]\\(f[0-9a-fA-F]{3})['"]''')
+FONT_SUBSET_FORMATS = ['woff2', 'woff', 'ttf']
+FONT_CSS_FORMATS = {'woff2': 'woff2', 'woff': 'woff', 'ttf': 'truetype'}
+
+VLQ_CHARS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+
+def options(opt):
+	opt.add_option('--no-css-prune', dest='nocssprune', action="store_true", default=False, help="Disable unused CSS pruning and critical CSS inlining")
+	opt.add_option('--no-critical-css', dest='nocriticalcss', action="store_true", default=False, help="Disable critical CSS inlining (pages link the pruned stylesheets directly)")
+	opt.add_option('--no-font-subset', dest='nofontsubset', action="store_true", default=False, help="Disable icon font subsetting")
+	opt.add_option('--no-js-bundle', dest='nojsbundle', action="store_true", default=False, help="Disable script bundling (templates keep their <script> tags)")
+
+def configure(conf):
+	conf.env.HAS_BLOG20_ASSETS = True
+	conf.env.DISABLE_CSS_PRUNE = conf.options.nocssprune
+	conf.env.DISABLE_CRITICAL_CSS = conf.options.nocssprune or conf.options.nocriticalcss
+
+	if conf.env.CRITICAL_ELEMENTS == []:
+		conf.env.CRITICAL_ELEMENTS = CRITICAL_ELEMENTS
+
+	conf.env.DISABLE_FONT_SUBSET = conf.options.nofontsubset
+	conf.env.FONT_SUBSET_FORMATS = list(FONT_SUBSET_FORMATS)
+	conf.env.DISABLE_JS_BUNDLE = conf.options.nojsbundle
+	conf.env.HAS_RJSMIN = False
+
+	#optional modules
+	try:
+		conf.start_msg("Checking for fontTools")
+		import fontTools.subset
+		conf.end_msg("OK")
+	except ImportError as e:
+		conf.end_msg('%s (icon font subsetting disabled)' % e, color = 'YELLOW')
+		conf.env.DISABLE_FONT_SUBSET = True
+
+	try:
+		conf.start_msg("Checking for brotli")
+		import brotli
+		conf.end_msg("OK")
+	except ImportError as e:
+		conf.end_msg('%s (no woff2 subsets)' % e, color = 'YELLOW')
+		conf.env.FONT_SUBSET_FORMATS.remove('woff2')
+
+	try:
+		conf.start_msg("Checking for rjsmin")
+		import rjsmin
+		conf.end_msg("OK")
+		conf.env.HAS_RJSMIN = True
+	except ImportError as e:
+		conf.end_msg('%s (scripts are bundled without minification)' % e, color = 'YELLOW')
+
+def parse_css(src):
+	"""
+		Parses a stylesheet into a list of blocks:
+			* ('stmt', text) for statements such as @import or @charset
+			* ('rule', selectors, body) for style rules
+			* ('at', prelude, body) for at-rules kept verbatim (@font-face, @keyframes ...)
+			* ('group', prelude, blocks) for conditional group rules (@media, @supports ...)
+	"""
+	src = CSS_COMMENT.sub('', src)
+	(blocks, _) = _parse_css_blocks(src, 0)
+	return blocks
+
+def _skip_string(src, pos):
+	quote = src[pos]
+	pos += 1
+	while pos < len(src) and src[pos] != quote:
+		if src[pos] == '\\':
+			pos += 1
+		pos += 1
+	return pos + 1
+
+def _parse_css_blocks(src, pos):
+	blocks = []
+	start = pos
+	while pos < len(src):
+		c = src[pos]
+		if c in '"\'':
+			pos = _skip_string(src, pos)
+		elif c == ';':
+			text = src[start:pos].strip()
+			if text:
+				blocks.append(('stmt', text))
+			pos += 1
+			start = pos
+		elif c == '}':
+			return (blocks, pos + 1)
+		elif c == '{':
+			prelude = ' '.join(src[start:pos].split())
+			if prelude.split(' ')[0].lower() in CSS_GROUP_RULES:
+				(children, pos) = _parse_css_blocks(src, pos + 1)
+				blocks.append(('group', prelude, children))
+			else:
+				depth = 1
+				body_start = pos + 1
+				pos += 1
+				while pos < len(src) and depth > 0:
+					if src[pos] in '"\'':
+						pos = _skip_string(src, pos)
+						continue
+					if src[pos] == '{':
+						depth += 1
+					elif src[pos] == '}':
+						depth -= 1
+					pos += 1
+				body = src[body_start:pos - 1]
+				if prelude.startswith('@'):
+					blocks.append(('at', prelude, body))
+				else:
+					blocks.append(('rule', split_selectors(prelude), body))
+			start = pos
+		else:
+			pos += 1
+	return (blocks, pos)
+
+def split_selectors(prelude):
+	"""
+		Splits a selector list on top level commas (ignores commas in :not(a, b) etc.)
+	"""
+	ret = []
+	depth = 0
+	start = 0
+	for i in range(0, len(prelude)):
+		c = prelude[i]
+		if c in '([':
+			depth += 1
+		elif c in ')]':
+			depth -= 1
+		elif c == ',' and depth == 0:
+			ret.append(prelude[start:i].strip())
+			start = i + 1
+	ret.append(prelude[start:].strip())
+	return [s for s in ret if s]
+
+def minify_css_body(body):
+	return ';'.join([' '.join(decl.split()) for decl in body.split(';') if decl.strip()])
+
+def serialize_css(blocks):
+	out = []
+	for block in blocks:
+		if block[0] == 'stmt':
+			out.append('%s;' % block[1])
+		elif block[0] == 'rule':
+			out.append('%s{%s}' % (','.join(block[1]), minify_css_body(block[2])))
+		elif block[0] == 'at':
+			out.append('%s{%s}' % (block[1], ' '.join(block[2].split())))
+		elif block[0] == 'group':
+			out.append('%s{%s}' % (block[1], serialize_css(block[2])))
+	return '\n'.join(out)
+
+def inline_css_imports(node, src = None, seen = None, replacements = None):
+	"""
+		Replaces local @import statements with the imported stylesheet's content.
+		Remote imports are hoisted to the top of the result since @import must precede all other rules.
+		`replacements` maps imported stylesheet nodes to the node that should be inlined instead.
+		Returns a tuple (source, list of imported nodes)
+	"""
+	if src == None:
+		src = node.read(encoding = 'utf-8')
+	if seen == None:
+		seen = []
+	if replacements == None:
+		replacements = {}
+	remote = []
+	deps = []
+
+	def replace(match):
+		url = match.group(1)
+		media = match.group(2).strip()
+		if '://' in url or url.startswith('//'):
+			remote.append(match.group(0))
+			return ''
+		imported = node.parent.find_node(url.split('?')[0])
+		if imported == None or imported in seen:
+			return match.group(0)
+		seen.append(imported)
+		if imported in replacements:
+			return replacements[imported].read(encoding = 'utf-8')
+		deps.append(imported)
+		(imported_src, imported_deps) = inline_css_imports(imported, None, seen, replacements)
+		deps.extend(imported_deps)
+		remote_in_import = [m.group(0) for m in CSS_IMPORT.finditer(imported_src)]
+		remote.extend(remote_in_import)
+		for r in remote_in_import:
+			imported_src = imported_src.replace(r, '')
+		if media:
+			return '@media %s{%s}' % (media, imported_src)
+		return imported_src
+
+	src = CSS_IMPORT.sub(replace, CSS_COMMENT.sub('', src))
+	return ('\n'.join(remote + [src]), deps)
+
+class UsedSelectors(object):
+	"""
+		Set of tag names, classes and ids found in documents
+	"""
+	def __init__(self):
+		self.tags = set(['html', 'head', 'body'])
+		self.classes = set()
+		self.ids = set()
+
+	def add_element(self, elm):
+		self.tags.add(elm.tagName.lower())
+		for c in elm.getAttribute('class').split():
+			self.classes.add(c)
+		if elm.getAttribute('id'):
+			self.ids.add(elm.getAttribute('id'))
+
+	def add_tokens(self, tokens):
+		#tokens with unknown role (from scripts, or explicitly kept)
+		for t in tokens:
+			self.classes.add(t)
+			self.ids.add(t)
+
+	def add_document(self, dom):
+		for elm in dom.getElementsByTagName('*'):
+			self.add_element(elm)
+
+	def add_document_above_fold(self, dom, limit, skip_ids = CRITICAL_SKIP_IDS):
+		count = [0]
+		def walk(elm):
+			for child in elm.childNodes:
+				if child.nodeType != child.ELEMENT_NODE:
+					continue
+				if count[0] >= limit:
+					return
+				if child.getAttribute('id') in skip_ids:
+					continue
+				self.add_element(child)
+				count[0] += 1
+				walk(child)
+		for body in dom.getElementsByTagName('body'):
+			walk(body)
+
+	SELECTOR_PSEUDO = re.compile(r'::?[\w-]+(\([^)]*\))?')
+	SELECTOR_ATTRIB = re.compile(r'\[[^\]]*\]')
+	SELECTOR_CLASS = re.compile(r'\.([\w-]+)')
+	SELECTOR_ID = re.compile(r'#([\w-]+)')
+	SELECTOR_TAG = re.compile(r'(?:^|[\s>+~])([a-zA-Z][\w-]*)')
+
+	def matches(self, selector):
+		"""
+			Conservative check: a selector is kept unless it references a tag, class or id that is never used
+		"""
+		if '\\' in selector:
+			return True
+		sel = self.SELECTOR_ATTRIB.sub('', self.SELECTOR_PSEUDO.sub('', selector))
+		for c in self.SELECTOR_CLASS.findall(sel):
+			if c not in self.classes:
+				return False
+		for i in self.SELECTOR_ID.findall(sel):
+			if i not in self.ids:
+				return False
+		for t in self.SELECTOR_TAG.findall(sel):
+			if t.lower() not in self.tags:
+				return False
+		return True
+
+def prune_css(blocks, used, keep_at_rules = True):
+	"""
+		Returns the blocks whose selectors may match the used selector set
+	"""
+	out = []
+	for block in blocks:
+		if block[0] == 'rule':
+			selectors = [s for s in block[1] if used.matches(s)]
+			if len(selectors) > 0:
+				out.append(('rule', selectors, block[2]))
+		elif block[0] == 'group':
+			children = prune_css(block[2], used, keep_at_rules)
+			if len(children) > 0:
+				out.append(('group', block[1], children))
+		elif keep_at_rules:
+			out.append(block)
+	return out
+
+def css_glyphs(blocks):
+	"""
+		Returns the set of private use area codepoints referenced by `content` declarations
+	"""
+	glyphs = set()
+	for block in blocks:
+		if block[0] == 'rule':
+			glyphs.update([int(g, 16) for g in CSS_GLYPH.findall(block[2])])
+		elif block[0] == 'group':
+			glyphs.update(css_glyphs(block[2]))
+	return glyphs
+
+def script_tokens(src):
+	"""
+		Collects identifier-like tokens from string literals in a script,
+		so classes added at runtime (addClass('is-loading')...) survive pruning
+	"""
+	tokens = set()
+	for match in re.finditer(r'''(['"])((?:\\.|(?!\1).)*?)\1''', src):
+		tokens.update(re.findall(r'[A-Za-z_][\w-]*', match.group(2)))
+	return tokens
+
+@TaskGen.taskgen_method
+def get_pruned_css(self):
+	"""
+		Returns a list of (original href, pruned stylesheet node, pruned href) for a css_prune task generator.
+		The pruned stylesheet mirrors the original's location so relative urls keep working.
+	"""
+	if getattr(self, 'pruned_css', None) == None:
+		self.pruned_css = []
+		root = self.get_static_dir_root()
+		for node in self.to_nodes(getattr(self, 'stylesheets', [])):
+			relpath = node.get_src().path_from(self.bld.srcnode).replace('\\', '/')
+			outnode = root.find_or_declare(relpath[:-len('.css')] + '.pruned.css')
+			self.pruned_css.append(('/' + relpath, outnode, '/' + outnode.path_from(root).replace('\\', '/')))
+	return self.pruned_css
+
+@TaskGen.taskgen_method
+def get_used_pages(self):
+	"""
+		Returns the generated (not yet published) pages of the task generators in `use`
+	"""
+	pages = []
+	uselist = self.to_list(getattr(self, 'use', []))
+	for usename in uselist:
+		try:
+			tg = self.bld.get_tgen_by_name(usename)
+			tg.post()
+		except WafError:
+			continue
+		pages.extend([t.outputs[0] for t in tg.tasks if t.__class__.__name__ in ('GeneratePageTemplate', 'GenerateIndex')])
+	return pages
+
+@TaskGen.feature("css_prune")
+def proc_css_prune(self):
+	"""
+		Writes stylesheets containing only the selectors used by the pages of the task generators in `use`
+			stylesheets: stylesheets linked by the templates
+			scripts: scripts whose string literals are treated as used classes/ids
+			css_keep: extra class/id names that must never be pruned
+			font_subset: name of a font_subset task generator whose stylesheet replaces the original icon font stylesheet
+	"""
+	if self.env.DISABLE_CSS_PRUNE:
+		return
+
+	pages = self.get_used_pages()
+	scripts = self.to_nodes(getattr(self, 'scripts', []))
+
+	replacements = {}
+	if getattr(self, 'font_subset', None) != None and not self.env.DISABLE_FONT_SUBSET:
+		(font_css, subset_css) = self.bld.get_tgen_by_name(self.font_subset).get_subset_css()
+		replacements[font_css] = subset_css
+
+	for (href, outnode, pruned_href) in self.get_pruned_css():
+		srcnode = self.bld.srcnode.find_node(href[1:])
+		tsk = self.create_task('PruneCss', [srcnode] + list(replacements.values()) + scripts + pages, [outnode])
+		tsk.pages = pages
+		tsk.scripts = scripts
+		tsk.css_keep = self.to_list(getattr(self, 'css_keep', []))
+		tsk.replacements = replacements
+
+@TaskGen.taskgen_method
+def find_css_prune(self):
+	"""
+		Returns (css_prune task generator, inline critical css): the one named by the `critical_css` attribute
+		(or env.CRITICAL_CSS) inlines critical CSS, otherwise pages only link the first css_prune task generator's stylesheets
+	"""
+	name = getattr(self, 'critical_css', self.env.CRITICAL_CSS)
+	if name:
+		try:
+			return (self.bld.get_tgen_by_name(name), not self.env.DISABLE_CRITICAL_CSS)
+		except WafError:
+			pass
+	for group in self.bld.groups:
+		for tg in group:
+			if 'css_prune' in self.to_list(getattr(tg, 'features', [])):
+				return (tg, False)
+	return (None, False)
+
+@TaskGen.taskgen_method
+def create_critical_css_task(self, srcnode, outnode):
+	"""
+		Called by publish_page: points the page at the pruned stylesheets and inlines its critical CSS
+	"""
+	if self.env.DISABLE_CSS_PRUNE:
+		return None
+	(tg, inline) = self.find_css_prune()
+	if tg == None:
+		return None
+	pruned = tg.get_pruned_css()
+	tsk = self.create_task('InlineCriticalCss', [srcnode] + [p[1] for p in pruned], [outnode])
+	tsk.pruned_css = pruned
+	tsk.inline = inline
+	tsk.css_keep = tg.to_list(getattr(tg, 'css_keep', []))
+	return tsk
+
+class PruneCss(Task.Task):
+	"""
+		Removes the rules of a stylesheet that can't match any generated page
+	"""
+	def sig_vars(self):
+		Task.Task.sig_vars(self)
+		self.m.update(repr(self.css_keep).encode('utf-8'))
+
+	def run(self):
+		(src, _) = inline_css_imports(self.inputs[0], None, None, self.replacements)
+
+		used = UsedSelectors()
+		used.add_tokens(self.css_keep)
+		for node in self.scripts:
+			used.add_tokens(script_tokens(node.read(encoding = 'utf-8')))
+		for node in self.pages:
+			used.add_document(minidom.parse(node.abspath()))
+
+		blocks = prune_css(parse_css(src), used)
+		self.outputs[0].parent.mkdir()
+		write_if_changed(self.outputs[0], serialize_css(blocks), encoding = 'utf-8')
+
+	def scan(self):
+		#rebuild when an imported stylesheet changes
+		return (inline_css_imports(self.inputs[0], None, None, self.replacements)[1], [])
+
+@TaskGen.taskgen_method
+def get_subset_css(self):
+	"""
+		Returns (original icon font stylesheet node, subset stylesheet node) for a font_subset task generator
+	"""
+	css = self.to_nodes(self.font_css)[0]
+	relpath = css.get_src().path_from(self.bld.srcnode).replace('\\', '/')
+	return (css, self.get_static_dir_root().find_or_declare(relpath[:-len('.css')] + '.subset.css'))
+
+@TaskGen.feature("font_subset")
+def proc_font_subset(self):
+	"""
+		Subsets an icon font to the glyphs used by the pages of the task generators in `use`
+			font_css: the icon font stylesheet (font-awesome.min.css), copies of it published by copyfiles are replaced by the subset
+			font: the font file to subset from (ttf/otf)
+			templates: templates scanned for icon classes in addition to the generated pages
+			glyph_css: other stylesheets that reference glyphs directly (content:'\f078')
+			font_family: font family of the @font-face rule to rewrite (default: FontAwesome)
+	"""
+	if self.env.DISABLE_FONT_SUBSET:
+		return
+
+	(css, subset_css) = self.get_subset_css()
+	font = self.to_nodes(self.font)[0]
+	templates = self.to_nodes(getattr(self, 'templates', []))
+	glyph_css = self.to_nodes(getattr(self, 'glyph_css', []))
+	pages = self.get_used_pages()
+
+	root = self.get_static_dir_root()
+	relpath = font.get_src().path_from(self.bld.srcnode).replace('\\', '/')
+	stem = relpath[:-len(font.suffix())]
+	fonts = [root.find_or_declare('%s.subset.%s' % (stem, fmt)) for fmt in self.env.FONT_SUBSET_FORMATS]
+
+	tsk = self.create_task('SubsetIconFont', [css, font] + glyph_css + templates + pages, [subset_css] + fonts)
+	tsk.pages = pages
+	tsk.templates = templates
+	tsk.glyph_css = glyph_css
+	tsk.font_family = getattr(self, 'font_family', 'FontAwesome')
+
+	#pages get the subset wherever the original stylesheet is published, e.g. through main.css's @import
+	self.override_static_copy(css, subset_css)
+
+class SubsetIconFont(Task.Task):
+	"""
+		Writes the icon font stylesheet without the unused icons, and the font files
+		subset to the remaining glyphs. Subsets are cached by glyph set.
+	"""
+	def run(self):
+		css = self.inputs[0]
+		font = self.inputs[1]
+		subset_css = self.outputs[0]
+		fonts = self.outputs[1:]
+
+		used = UsedSelectors()
+		for node in self.templates:
+			used.add_tokens(re.findall(r'fa-[\w-]+', node.read(encoding = 'utf-8')))
+		for node in self.pages:
+			used.add_document(minidom.parse(node.abspath()))
+
+		blocks = prune_css(parse_css(css.read(encoding = 'utf-8')), used)
+		glyphs = css_glyphs(blocks)
+		for node in self.glyph_css:
+			glyphs.update(css_glyphs(prune_css(parse_css(node.read(encoding = 'utf-8')), used)))
+
+		#cache by glyph set and source font
+		glyph_list = sorted(glyphs)
+		key = Utils.to_hex(Utils.h_list([Utils.h_file(font.abspath())] + glyph_list))
+		cachedir = self.generator.bld.bldnode.make_node('font_subset_cache').make_node(key)
+		cachedir.mkdir()
+		for (fmt, outnode) in zip(self.env.FONT_SUBSET_FORMATS, fonts):
+			cached = cachedir.make_node('subset.%s' % fmt)
+			if not os.path.exists(cached.abspath()):
+				self.subset_font(font, cached, fmt, glyph_list)
+			outnode.parent.mkdir()
+			copy_if_changed(cached.abspath(), outnode.abspath())
+
+		#absolute urls: the stylesheet is also published in place of the original one
+		root = self.generator.get_static_dir_root()
+		srcs = []
+		for (fmt, outnode) in zip(self.env.FONT_SUBSET_FORMATS, fonts):
+			url = '/' + outnode.path_from(root).replace('\\', '/')
+			srcs.append("url('%s?v=%s') format('%s')" % (url, key[:8], FONT_CSS_FORMATS[fmt]))
+
+		out = []
+		for block in blocks:
+			if block[0] == 'at' and block[1].lower() == '@font-face' and self.font_family in block[2]:
+				decls = [d for d in block[2].split(';') if d.strip() and d.split(':')[0].strip() != 'src']
+				decls.append('src:%s' % ','.join(srcs))
+				block = ('at', block[1], ';'.join(decls))
+			out.append(block)
+
+		subset_css.parent.mkdir()
+		write_if_changed(subset_css, serialize_css(out), encoding = 'utf-8')
+
+	def subset_font(self, font, outnode, fmt, glyphs):
+		from fontTools import subset
+		options = subset.Options()
+		options.flavor = fmt if fmt != 'ttf' else None
+		ttfont = subset.load_font(font.abspath(), options)
+		subsetter = subset.Subsetter(options)
+		subsetter.populate(unicodes = glyphs)
+		subsetter.subset(ttfont)
+		subset.save_font(ttfont, outnode.abspath(), options)
+
+def vlq_encode(values):
+	"""
+		Base64 VLQ encoding of a source map segment
+	"""
+	out = ''
+	for value in values:
+		value = (-value << 1) | 1 if value < 0 else value << 1
+		while True:
+			digit = value & 31
+			value >>= 5
+			if value > 0:
+				digit |= 32
+			out += VLQ_CHARS[digit]
+			if value == 0:
+				break
+	return out
+
+def template_scripts(tpl):
+	"""
+		Returns the local, classic <script src> elements of a template.
+		Scripts in conditional comments (IE shims), modules and remote scripts are not returned.
+	"""
+	dom = minidom.parse(tpl.abspath())
+	scripts = []
+	for elm in dom.getElementsByTagName('script'):
+		src = elm.getAttribute('src')
+		if not src.startswith('/') or src.startswith('//') or elm.getAttribute('type') == 'module':
+			continue
+		scripts.append(elm)
+	return (dom, scripts)
+
+@TaskGen.taskgen_method
+def get_bundle_nodes(self):
+	"""
+		Returns (bundle node, source map node, bundled template node) for a js_bundle task generator
+	"""
+	if getattr(self, 'bundle_nodes', None) == None:
+		tpl = self.to_nodes(self.template)[0]
+		outdir = self.get_static_dir().find_or_declare(self.target)
+		name = getattr(self, 'bundle_name', 'bundle.js')
+		tmpdir = self.path.find_or_declare("tmp/bundle")
+		self.bundle_nodes = (
+			outdir.find_or_declare(name),
+			outdir.find_or_declare(name + '.map'),
+			tmpdir.find_or_declare(tpl.name)
+		)
+	return self.bundle_nodes
+
+@TaskGen.taskgen_method
+def get_bundled_template(self, tpl):
+	"""
+		Called by get_page_template: returns the bundled version of a template when a js_bundle task generator
+		for it is named by the `js_bundle` attribute (or env.JS_BUNDLE)
+	"""
+	name = getattr(self, 'js_bundle', self.env.JS_BUNDLE)
+	if not name or self.env.DISABLE_JS_BUNDLE:
+		return tpl
+	try:
+		tg = self.bld.get_tgen_by_name(name)
+	except WafError:
+		return tpl
+	if tg.to_nodes(tg.template)[0] != tpl:
+		return tpl
+	return tg.get_bundle_nodes()[2]
+
+@TaskGen.feature("js_bundle")
+def proc_js_bundle(self):
+	"""
+		Bundles the scripts of a template into a single deferred script
+			template: the template to rewrite
+			bundle_name: name of the bundle (default: bundle.js)
+			js_exclude: script urls to leave untouched
+	"""
+	if self.env.DISABLE_JS_BUNDLE:
+		return
+	tpl = self.to_nodes(self.template)[0]
+	exclude = self.to_list(getattr(self, 'js_exclude', []))
+
+	scripts = []
+	(_, elms) = template_scripts(tpl)
+	for elm in elms:
+		src = elm.getAttribute('src')
+		node = self.bld.srcnode.find_node(src[1:])
+		if src in exclude:
+			continue
+		if node == None:
+			raise WafError('Script "%s" referenced by "%s" was not found' % (src, tpl.abspath()))
+		scripts.append((src, node))
+
+	(bundle, srcmap, bundled_tpl) = self.get_bundle_nodes()
+	tsk = self.create_task('BundleScripts', [tpl] + [s[1] for s in scripts], [bundle, srcmap, bundled_tpl])
+	tsk.scripts = scripts
+	tsk.bundle_href = '/' + bundle.path_from(self.get_static_dir_root()).replace('\\', '/')
+
+class BundleScripts(Task.Task):
+	"""
+		Concatenates (and minifies) a template's scripts in declared order into one bundle
+		with a source map, and replaces their <script> tags with a single deferred one
+	"""
+	def run(self):
+		(bundle, srcmap, bundled_tpl) = self.outputs
+
+		chunks = []
+		mappings = []
+		prev = [0, 0]
+		for (i, (src, node)) in enumerate(self.scripts):
+			js = node.read(encoding = 'utf-8')
+			minified = False
+			if self.env.HAS_RJSMIN and not node.name.endswith('.min.js'):
+				import rjsmin
+				js = rjsmin.jsmin(js)
+				minified = True
+			lines = js.rstrip().splitlines() or ['']
+			#lines are mapped 1:1 for unminified scripts, minified scripts only map to their first line
+			for (line, _) in enumerate(lines):
+				srcline = 0 if minified else line
+				mappings.append(vlq_encode([0, i - prev[0], srcline - prev[1], 0]))
+				prev = [i, srcline]
+			#terminate statements that rely on automatic semicolon insertion
+			chunks.append('\n'.join(lines) + ';')
+
+		out_js = '\n'.join(chunks) + '\n'
+		bundle.parent.mkdir()
+		write_if_changed(bundle, out_js + '//# sourceMappingURL=%s\n' % srcmap.name, encoding = 'utf-8')
+		write_if_changed(srcmap, json.dumps({
+			'version': 3,
+			'file': bundle.name,
+			'sources': [s[0] for s in self.scripts],
+			'names': [],
+			'mappings': ';'.join(mappings)
+		}), encoding = 'utf-8')
+
+		version = Utils.to_hex(Utils.h_list([out_js]))[:8]
+		(dom, elms) = template_scripts(self.inputs[0])
+		bundled = [s[0] for s in self.scripts]
+		first = None
+		for elm in elms:
+			if elm.getAttribute('src') not in bundled:
+				continue
+			if first == None:
+				first = dom.createElement('script')
+				first.setAttribute('src', '%s?v=%s' % (self.bundle_href, version))
+				first.setAttribute('defer', 'defer')
+				#avoid <script/> which browsers don't close
+				first.appendChild(dom.createTextNode(';'))
+				elm.parentNode.insertBefore(first, elm)
+			elm.parentNode.removeChild(elm)
+
+		bundled_tpl.parent.mkdir()
+		write_if_changed(bundled_tpl, dom.toxml(), encoding = 'utf-8')
+
+class InlineCriticalCss(Task.Task):
+	"""
+		Inlines the rules needed above the fold into the page's <head>
+		and loads the pruned stylesheets asynchronously.
+		Without inlining, the page's links are only pointed at the pruned stylesheets.
+	"""
+	vars = ['CRITICAL_ELEMENTS']
+
+	def sig_vars(self):
+		Task.Task.sig_vars(self)
+		self.m.update(repr((self.inline, self.css_keep, [(p[0], p[2]) for p in self.pruned_css])).encode('utf-8'))
+
+	def link_pruned(self, dom):
+		links = dict([(p[0], p[2]) for p in self.pruned_css])
+		for link in dom.getElementsByTagName('head')[0].getElementsByTagName('link'):
+			if link.getAttribute('rel') == 'stylesheet' and link.getAttribute('href') in links:
+				link.setAttribute('href', links[link.getAttribute('href')])
+		return dom.toxml()
+
+	def run(self):
+		dom = minidom.parse(self.inputs[0].abspath())
+		if not self.inline:
+			self.outputs[0].parent.mkdir()
+			write_if_changed(self.outputs[0], self.link_pruned(dom), encoding = 'utf-8')
+			return
+
+		used = UsedSelectors()
+		used.add_tokens(self.css_keep)
+		used.add_document_above_fold(dom, int(self.env.CRITICAL_ELEMENTS or CRITICAL_ELEMENTS))
+
+		critical = []
+		for (href, node, pruned_href) in self.pruned_css:
+			critical.extend(prune_css(parse_css(node.read(encoding = 'utf-8')), used, False))
+
+		head = dom.getElementsByTagName('head')[0]
+		links = dict([(p[0], p[2]) for p in self.pruned_css])
+		first = None
+		for link in head.getElementsByTagName('link'):
+			if link.getAttribute('rel') != 'stylesheet' or link.getAttribute('href') not in links:
+				continue
+			href = links[link.getAttribute('href')]
+			if first == None:
+				first = link
+
+			preload = dom.createElement('link')
+			preload.setAttribute('rel', 'preload')
+			preload.setAttribute('as', 'style')
+			preload.setAttribute('href', href)
+			preload.setAttribute('onload', "this.onload=null;this.rel='stylesheet'")
+
+			noscript = dom.createElement('noscript')
+			fallback = dom.createElement('link')
+			fallback.setAttribute('rel', 'stylesheet')
+			fallback.setAttribute('href', href)
+			noscript.appendChild(fallback)
+
+			head.insertBefore(preload, link)
+			head.insertBefore(noscript, link)
+			head.removeChild(link)
+			if first == link:
+				first = preload
+
+		#<style> content is raw text in HTML, keep minidom from escaping selectors like `a > b`
+		placeholder = '@@CRITICAL_CSS@@'
+		if first != None and len(critical) > 0:
+			style = dom.createElement('style')
+			style.appendChild(dom.createTextNode(placeholder))
+			head.insertBefore(style, first)
+
+		xml_out = dom.toxml().replace(placeholder, serialize_css(critical).replace('</', '<\\/'), 1)
+		self.outputs[0].parent.mkdir()
+		write_if_changed(self.outputs[0], xml_out, encoding = 'utf-8')
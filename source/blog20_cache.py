@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+#shared build cache for task outputs
+#load after blog20 and blog20_media so their task classes exist
+
+from waflib import Task, Utils, Logs
+import os, json, time, threading, tempfile
+import urllib.request, urllib.error
+
+#tasks that may be downloaded from the cache instead of running
+CACHE_TASKS = ['ConvertImage', 'OptimizeGif', 'BuildMdContent', 'Pygmentize']
+
+#inputs of the tasks that aren't part of waf's task signature
+CACHE_VARS = {
+	'ConvertImage': ['MAX_IMG_DIMENSION', 'IMAGE_FMT_OUT'],
+	'BuildMdContent': ['DATE_FORMAT_STRING', 'img_replacement_map'],
+}
+CACHE_ATTRS = {
+	'ConvertImage': ['do_shrink'],
+	'OptimizeGif': ['gif_options'],
+}
+#inputs read from the task generator or from the input nodes
+CACHE_EXTRA = {
+	'Pygmentize': lambda tsk: repr(getattr(tsk.generator, 'syntax_themes', None)),
+	'ConvertImage': lambda tsk: repr([(getattr(n, 'make_square', False), getattr(n, 'max_dimension', None)) for n in tsk.inputs]),
+}
+
+def options(opt):
+	opt.add_option('--build-cache', dest='build_cache', type='string', default=os.environ.get('BLOG20_CACHE', ''), help='Shared build cache: a directory or an http:// url (default: $BLOG20_CACHE)')
+	opt.add_option('--build-cache-readonly', dest='build_cache_ro', action="store_true", default=False, help="Only download from the build cache, never upload")
+
+def configure(conf):
+	conf.env.HAS_BLOG20_CACHE = True
+	conf.env.BUILD_CACHE = conf.options.build_cache
+	conf.env.BUILD_CACHE_READONLY = conf.options.build_cache_ro
+	if conf.env.BUILD_CACHE_TASKS == []:
+		conf.env.BUILD_CACHE_TASKS = CACHE_TASKS
+	if conf.env.BUILD_CACHE:
+		conf.msg("Build cache", conf.env.BUILD_CACHE)
+
+def setup(bld):
+	wrap_task_classes()
+
+def pack_outputs(blobs):
+	"""
+		All outputs of a task are stored as a single entry:
+		a json list of sizes on the first line followed by the concatenated contents
+	"""
+	return json.dumps([len(b) for b in blobs]).encode('utf-8') + b'\n' + b''.join(blobs)
+
+def unpack_outputs(data):
+	(header, data) = data.split(b'\n', 1)
+	blobs = []
+	pos = 0
+	for size in json.loads(header.decode('utf-8')):
+		blobs.append(data[pos:pos + size])
+		pos += size
+	if pos != len(data):
+		raise ValueError('corrupted cache entry')
+	return blobs
+
+class DirCache(object):
+	"""
+		Cache entries stored as files in a shared directory (network share, CI cache volume ...)
+	"""
+	def __init__(self, path):
+		self.path = path
+
+	def entry(self, key):
+		return os.path.join(self.path, key[:2], key)
+
+	def get(self, key):
+		try:
+			with open(self.entry(key), 'rb') as f:
+				return f.read()
+		except IOError:
+			return None
+
+	def put(self, key, data):
+		path = self.entry(key)
+		if os.path.exists(path):
+			return False
+		os.makedirs(os.path.dirname(path), exist_ok = True)
+		#write then rename so concurrent readers never see partial entries
+		(fd, tmp) = tempfile.mkstemp(dir = os.path.dirname(path))
+		with os.fdopen(fd, 'wb') as f:
+			f.write(data)
+		os.replace(tmp, path)
+		return True
+
+class HttpCache(object):
+	"""
+		Cache entries stored on a server answering GET/PUT <url>/<key> (see blog20_cache_server.py)
+	"""
+	def __init__(self, url, timeout = 10):
+		self.url = url.rstrip('/')
+		self.timeout = timeout
+
+	def get(self, key):
+		try:
+			with urllib.request.urlopen('%s/%s' % (self.url, key), timeout = self.timeout) as r:
+				return r.read()
+		except urllib.error.HTTPError as e:
+			if e.code == 404:
+				return None
+			raise
+
+	def put(self, key, data):
+		req = urllib.request.Request('%s/%s' % (self.url, key), data = data, method = 'PUT')
+		with urllib.request.urlopen(req, timeout = self.timeout) as r:
+			#200 when the entry already existed
+			return r.status == 201
+
+class BuildCache(object):
+	def __init__(self, bld):
+		self.bld = bld
+		url = bld.env.BUILD_CACHE
+		if url.startswith('http://') or url.startswith('https://'):
+			self.backend = HttpCache(url)
+		else:
+			self.backend = DirCache(os.path.abspath(os.path.expanduser(url)))
+		self.readonly = bld.env.BUILD_CACHE_READONLY
+		self.lock = threading.Lock()
+		self.stats = {}
+		self.disabled = False
+
+	def count(self, cls, what, amount = 1):
+		with self.lock:
+			s = self.stats.setdefault(cls, {'hits': 0, 'misses': 0, 'stored': 0, 'errors': 0, 'downloaded': 0, 'uploaded': 0, 'time': 0.0})
+			s[what] += amount
+
+	def error(self, tsk, e):
+		self.count(tsk.__class__.__name__, 'errors')
+		with self.lock:
+			if not self.disabled:
+				Logs.warn('Build cache unavailable, disabling it for this build: %s' % e)
+			self.disabled = True
+
+	def key(self, tsk):
+		"""
+			The waf task signature plus the task's inputs waf doesn't know about.
+			Paths are made relative to the project so keys are shared between machines.
+		"""
+		bld = self.bld
+		clsname = tsk.__class__.__name__
+		values = [Utils.to_hex(tsk.signature()), clsname]
+		values.extend([n.path_from(bld.bldnode) for n in tsk.outputs])
+		values.extend([repr(tsk.env[v]) for v in CACHE_VARS.get(clsname, [])])
+		values.extend([repr(getattr(tsk, a, None)) for a in CACHE_ATTRS.get(clsname, [])])
+		if clsname in CACHE_EXTRA:
+			values.append(CACHE_EXTRA[clsname](tsk))
+		key = '\n'.join(values).replace(bld.bldnode.abspath(), '').replace(bld.srcnode.abspath(), '')
+		return Utils.to_hex(Utils.h_list([key]))
+
+	def fetch(self, tsk):
+		clsname = tsk.__class__.__name__
+		try:
+			data = self.backend.get(self.key(tsk))
+			if data == None:
+				self.count(clsname, 'misses')
+				return False
+			blobs = unpack_outputs(data)
+		except Exception as e:
+			self.error(tsk, e)
+			return False
+
+		if len(blobs) != len(tsk.outputs):
+			self.count(clsname, 'misses')
+			return False
+		for (node, blob) in zip(tsk.outputs, blobs):
+			node.parent.mkdir()
+			node.write(blob, 'wb')
+		self.count(clsname, 'hits')
+		self.count(clsname, 'downloaded', len(data))
+		return True
+
+	def store(self, tsk, duration):
+		clsname = tsk.__class__.__name__
+		self.count(clsname, 'time', duration)
+		if self.readonly or self.disabled:
+			return
+		try:
+			data = pack_outputs([node.read('rb') for node in tsk.outputs])
+			if self.backend.put(self.key(tsk), data):
+				self.count(clsname, 'stored')
+				self.count(clsname, 'uploaded', len(data))
+		except Exception as e:
+			self.error(tsk, e)
+
+	def report(self, bld):
+		if len(self.stats) == 0:
+			return
+		Logs.pprint('CYAN', 'Build cache statistics (%s):' % bld.env.BUILD_CACHE)
+		Logs.pprint('NORMAL', '  %-20s %6s %6s %6s %6s %12s %12s %10s' % ('task', 'hits', 'misses', 'stored', 'errors', 'downloaded', 'uploaded', 'run time'))
+		total = [0, 0]
+		for clsname in sorted(self.stats.keys()):
+			s = self.stats[clsname]
+			total[0] += s['hits']
+			total[1] += s['hits'] + s['misses']
+			Logs.pprint('NORMAL', '  %-20s %6d %6d %6d %6d %12s %12s %9.2fs' % (
+				clsname, s['hits'], s['misses'], s['stored'], s['errors'],
+				format_size(s['downloaded']), format_size(s['uploaded']), s['time']
+			))
+		if total[1] > 0:
+			Logs.pprint('CYAN', '  hit rate: %d/%d (%d%%)' % (total[0], total[1], 100 * total[0] / total[1]))
+
+def format_size(size):
+	for unit in ['B', 'KB', 'MB']:
+		if size < 1024:
+			return '%.1f%s' % (size, unit) if unit != 'B' else '%d%s' % (size, unit)
+		size /= 1024.0
+	return '%.1fGB' % size
+
+cache_lock = threading.Lock()
+
+def get_cache(bld):
+	"""
+		The cache is created on first use and reports its statistics when the build ends
+	"""
+	if not bld.env.BUILD_CACHE:
+		return None
+	with cache_lock:
+		if getattr(bld, 'build_cache', None) == None:
+			bld.build_cache = BuildCache(bld)
+			bld.add_post_fun(bld.build_cache.report)
+	if bld.build_cache.disabled:
+		return None
+	return bld.build_cache
+
+def wrap_run(cls):
+	run = cls.run
+	def cached_run(self):
+		if self.__class__.__name__ not in self.env.BUILD_CACHE_TASKS:
+			return run(self)
+		cache = get_cache(self.generator.bld)
+		if cache != None and cache.fetch(self):
+			#let tasks restore the state a normal run would have left (e.g. BuildMdContent.meta)
+			if hasattr(self, 'restore_from_cache'):
+				self.restore_from_cache()
+			return 0
+		start = time.time()
+		ret = run(self)
+		if cache != None and not ret:
+			cache.store(self, time.time() - start)
+		return ret
+	cls.run = cached_run
+	cls.build_cache_wrapped = True
+
+def wrap_task_classes(names = CACHE_TASKS):
+	for name in names:
+		cls = Task.classes.get(name, None)
+		if cls != None and not getattr(cls, 'build_cache_wrapped', False):
+			wrap_run(cls)
+
+wrap_task_classes()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+#reference server for the blog20_cache http backend
+#	python blog20_cache_server.py --port 8765 --dir /tmp/blog20-cache
+#	waf configure --build-cache=http://localhost:8765
+
+import os, argparse, tempfile, re
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+KEY = re.compile(r'^/([0-9a-f]{8,64})$')
+
+class CacheHandler(BaseHTTPRequestHandler):
+	def entry(self):
+		match = KEY.match(self.path)
+		if match == None:
+			self.send_error(400, 'bad cache key')
+			return None
+		key = match.group(1)
+		return os.path.join(self.server.cache_dir, key[:2], key)
+
+	def do_GET(self):
+		path = self.entry()
+		if path == None:
+			return
+		try:
+			with open(path, 'rb') as f:
+				data = f.read()
+		except IOError:
+			self.send_error(404)
+			return
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/octet-stream')
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def do_PUT(self):
+		path = self.entry()
+		if path == None:
+			return
+		size = int(self.headers.get('Content-Length', 0))
+		if size > self.server.max_size:
+			self.send_error(413)
+			return
+		data = self.rfile.read(size)
+		if os.path.exists(path):
+			#entries are immutable, the first upload wins
+			self.send_response(200)
+		else:
+			os.makedirs(os.path.dirname(path), exist_ok = True)
+			(fd, tmp) = tempfile.mkstemp(dir = os.path.dirname(path))
+			with os.fdopen(fd, 'wb') as f:
+				f.write(data)
+			os.replace(tmp, path)
+			self.send_response(201)
+		self.send_header('Content-Length', '0')
+		self.end_headers()
+
+def main():
+	parser = argparse.ArgumentParser(description = 'blog20 build cache server')
+	parser.add_argument('--host', default = 'localhost')
+	parser.add_argument('--port', type = int, default = 8765)
+	parser.add_argument('--dir', default = 'build-cache', help = 'directory where entries are stored')
+	parser.add_argument('--max-size', type = int, default = 256 * 1024 * 1024, help = 'largest accepted entry in bytes')
+	args = parser.parse_args()
+
+	server = ThreadingHTTPServer((args.host, args.port), CacheHandler)
+	server.cache_dir = os.path.abspath(args.dir)
+	server.max_size = args.max_size
+	print('Serving build cache from "%s" on http://%s:%d' % (server.cache_dir, args.host, args.port))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+#checks of the static output: page weight, links and assets
+
+from waflib import TaskGen, Logs, Errors, Options, Build
+from html.parser import HTMLParser
+import os, re, zlib, json, hashlib, fnmatch, posixpath
+from urllib.parse import urlsplit, unquote
+from blog20 import fork_context
+
+#resources fetched by a page, per element: attributes holding urls
+PAGE_RESOURCES = {
+	'img': ['src', 'srcset'],
+	'source': ['src', 'srcset'],
+	'script': ['src'],
+	'model-viewer': ['src', 'poster'],
+	'video': ['src', 'poster'],
+	'audio': ['src'],
+	'iframe': ['src'],
+}
+#<link rel=...> values whose href is fetched with the page
+LINK_RESOURCES = ['stylesheet', 'preload', 'icon', 'shortcut']
+
+#types served compressed, weighed by their gzip size
+COMPRESSED_TYPES = ['.html', '.css', '.js', '.json', '.svg', '.xml', '.map', '.txt']
+
+#files parsed by the link checker and attributes whose urls must resolve, on any element
+CHECK_TYPES = ['.html', '.htm', '.xml']
+CHECK_ATTRS = ['href', 'src', 'srcset', 'poster', 'data-src']
+
+CSS_URL = re.compile(r'''url\(\s*['"]?([^'")]+)['"]?\s*\)''')
+CSS_IMPORT_URL = re.compile(r'''@import\s+(?:url\()?\s*['"]?([^'")\s;]+)''')
+CSS_FONT_FACE = re.compile(r'@font-face\s*{([^}]*)}')
+FONT_PREFERENCE = ['woff2', 'woff', 'truetype', 'opentype']
+
+def options(opt):
+	opt.add_option('--page-budget-kb', dest='page_budget_kb', type='int', default=0, help='Fail the build when a page weighs more than this many KB, resources included (default: 0, no budget)')
+	opt.add_option('--page-budget-requests', dest='page_budget_requests', type='int', default=0, help='Fail the build when a page needs more requests than this (default: 0, no budget)')
+
+def configure(conf):
+	conf.env.HAS_BLOG20_CHECK = True
+	if conf.env.PAGE_BUDGET_KB == []:
+		conf.env.PAGE_BUDGET_KB = conf.options.page_budget_kb
+	if conf.env.PAGE_BUDGET_REQUESTS == []:
+		conf.env.PAGE_BUDGET_REQUESTS = conf.options.page_budget_requests
+
+class PageReferences(HTMLParser):
+	"""
+		Collects the urls referenced by a page as (tag, attribute, url) tuples.
+		Markup in comments (IE conditional includes) is ignored.
+	"""
+	def __init__(self):
+		HTMLParser.__init__(self)
+		self.refs = []
+
+	def handle_starttag(self, tag, attrs):
+		attrs = dict([(k, v or '') for (k, v) in attrs])
+		#inline backgrounds, e.g. thumbnail atlas tiles
+		for url in CSS_URL.findall(attrs.get('style', '')):
+			self.refs.append((tag, 'style', url))
+		if tag == 'link':
+			rel = attrs.get('rel', '').lower().split()
+			if len([r for r in rel if r in LINK_RESOURCES]) > 0 and attrs.get('href'):
+				self.refs.append((tag, 'href', attrs['href']))
+			return
+		for attr in PAGE_RESOURCES.get(tag, []):
+			value = attrs.get(attr, '')
+			if attr == 'srcset':
+				for candidate in value.split(','):
+					if candidate.strip():
+						self.refs.append((tag, attr, candidate.split()[0]))
+			elif value:
+				self.refs.append((tag, attr, value))
+
+	handle_startendtag = handle_starttag
+
+def parse_page_references(src):
+	parser = PageReferences()
+	parser.feed(src)
+	parser.close()
+	return parser.refs
+
+def is_local_url(url):
+	parts = urlsplit(url)
+	return parts.scheme == '' and parts.netloc == '' and not url.startswith('#')
+
+def resolve_url(url, page, root):
+	"""
+		Returns the path of a local url in the static directory `root`, relative to the referencing file `page`
+	"""
+	path = unquote(urlsplit(url).path)
+	if path == '':
+		return page
+	if path.startswith('/'):
+		target = os.path.join(root, path.lstrip('/'))
+	else:
+		target = os.path.join(os.path.dirname(page), path)
+	target = os.path.normpath(target)
+	if os.path.isdir(target):
+		target = os.path.join(target, 'index.html')
+	return target
+
+def css_references(src):
+	"""
+		Returns the urls a stylesheet makes the browser download: imports and one font file per @font-face.
+		Background images are only fetched when their rule matches, they aren't counted.
+	"""
+	urls = CSS_IMPORT_URL.findall(src)
+	for face in CSS_FONT_FACE.findall(src):
+		#browsers fetch the first supported format of the last src declaration
+		srcs = [d.split(':', 1)[1] for d in face.split(';') if d.strip().startswith('src')]
+		if len(srcs) == 0:
+			continue
+		candidates = re.findall(r'''url\(\s*['"]?([^'")]+)['"]?\s*\)\s*(?:format\(\s*['"]?([\w-]+)['"]?\s*\))?''', srcs[-1])
+		formats = [f for (u, f) in candidates]
+		chosen = None
+		for pref in FONT_PREFERENCE:
+			if pref in formats:
+				chosen = candidates[formats.index(pref)][0]
+				break
+		if chosen == None and len(candidates) > 0:
+			chosen = candidates[0][0]
+		if chosen != None:
+			urls.append(chosen)
+	return urls
+
+class PageWeigher(object):
+	"""
+		Computes the transfer size and request count of pages, sharing file sizes between pages
+	"""
+	def __init__(self, root):
+		self.root = root
+		self.sizes = {}
+		self.css = {}
+
+	def transfer_size(self, path):
+		if path not in self.sizes:
+			with open(path, 'rb') as f:
+				data = f.read()
+			if os.path.splitext(path)[1].lower() in COMPRESSED_TYPES:
+				self.sizes[path] = len(zlib.compress(data, 6))
+			else:
+				self.sizes[path] = len(data)
+		return self.sizes[path]
+
+	def stylesheet_resources(self, path, seen):
+		if path in self.css:
+			return self.css[path]
+		resources = []
+		with open(path, 'r', encoding = 'utf-8', errors = 'replace') as f:
+			for url in css_references(f.read()):
+				if not is_local_url(url):
+					continue
+				target = resolve_url(url, path, self.root)
+				if target in seen or not os.path.isfile(target):
+					continue
+				seen.add(target)
+				resources.append(target)
+				if target.endswith('.css'):
+					resources.extend(self.stylesheet_resources(target, seen))
+		self.css[path] = resources
+		return resources
+
+	def resources(self, page):
+		"""
+			Returns ([paths of the local files fetched with the page, the page first], external urls)
+		"""
+		with open(page, 'r', encoding = 'utf-8', errors = 'replace') as f:
+			refs = parse_page_references(f.read())
+
+		resources = [page]
+		external = set()
+		seen = set([page])
+		for (tag, attr, url) in refs:
+			if not is_local_url(url):
+				if urlsplit(url).scheme in ('http', 'https', ''):
+					external.add(url)
+				continue
+			target = resolve_url(url, page, self.root)
+			if target in seen or not os.path.isfile(target):
+				continue
+			seen.add(target)
+			resources.append(target)
+			if target.endswith('.css'):
+				resources.extend(self.stylesheet_resources(target, seen))
+		return (resources, external)
+
+	def weigh(self, page):
+		"""
+			Returns (transfer bytes, local requests, external requests, [(bytes, path)] of the page's resources)
+		"""
+		(resources, external) = self.resources(page)
+		weights = sorted([(self.transfer_size(r), r) for r in resources], reverse = True)
+		return (sum([w[0] for w in weights]), len(resources), len(external), weights)
+
+def page_budget(budgets, relpath, default_bytes, default_requests):
+	"""
+		Budgets are (bytes, requests), `budgets` maps page path patterns (fnmatch) to {'kb': ..., 'requests': ...}
+	"""
+	(max_bytes, max_requests) = (default_bytes, default_requests)
+	for pattern in sorted(budgets.keys()):
+		if fnmatch.fnmatch(relpath, pattern):
+			max_bytes = budgets[pattern].get('kb', max_bytes / 1024) * 1024
+			max_requests = budgets[pattern].get('requests', max_requests)
+	return (max_bytes, max_requests)
+
+def format_kb(size):
+	return '%.1f KB' % (size / 1024.0)
+
+def write_page_report(bld, static_dir, budgets, top, default_bytes, default_requests):
+	root = static_dir.abspath()
+	weigher = PageWeigher(root)
+
+	pages = []
+	for (dirpath, dirnames, filenames) in os.walk(root):
+		dirnames.sort()
+		for name in sorted(filenames):
+			if name.endswith('.html'):
+				page = os.path.join(dirpath, name)
+				pages.append((posixpath.join(*os.path.relpath(page, root).split(os.sep)), weigher.weigh(page)))
+
+	pages.sort(key = lambda p: (-p[1][0], p[0]))
+	Logs.pprint('CYAN', 'Heaviest pages (transfer size, requests):')
+	for (relpath, (size, requests, external, weights)) in pages[:top]:
+		Logs.pprint('NORMAL', '  %-48s %12s %4d requests (+%d external)' % (relpath, format_kb(size), requests, external))
+		for (w, r) in weights[:3]:
+			Logs.pprint('NORMAL', '      %12s  %s' % (format_kb(w), os.path.relpath(r, root).replace(os.sep, '/')))
+
+	over = []
+	for (relpath, (size, requests, external, weights)) in pages:
+		(max_bytes, max_requests) = page_budget(budgets, relpath, default_bytes, default_requests)
+		if max_bytes > 0 and size > max_bytes:
+			over.append('%s: %s > %s' % (relpath, format_kb(size), format_kb(max_bytes)))
+		if max_requests > 0 and requests + external > max_requests:
+			over.append('%s: %d requests > %d' % (relpath, requests + external, max_requests))
+
+	if len(over) > 0:
+		raise Errors.WafError('Page budgets exceeded:\n\t%s' % '\n\t'.join(over))
+
+@TaskGen.feature("page_report")
+def proc_page_report(self):
+	"""
+		Once the build succeeds, reports the heaviest pages of the static directory and enforces budgets
+			page_budgets: {'pattern': {'kb': ..., 'requests': ...}} overriding --page-budget-kb/--page-budget-requests
+			report_top: number of pages listed (default: 10)
+	"""
+	static_dir = self.get_static_dir_root()
+	budgets = getattr(self, 'page_budgets', {})
+	top = getattr(self, 'report_top', 10)
+	default_bytes = int(self.env.PAGE_BUDGET_KB or 0) * 1024
+	default_requests = int(self.env.PAGE_BUDGET_REQUESTS or 0)
+	self.bld.add_post_fun(lambda bld: write_page_report(bld, static_dir, budgets, top, default_bytes, default_requests))
+
+class LinkReferences(HTMLParser):
+	"""
+		Collects the urls of a file as [line, tag, attribute, url] and its element ids.
+		A <model-viewer> without src or data-src is reported with an empty src.
+	"""
+	def __init__(self):
+		HTMLParser.__init__(self)
+		self.links = []
+		self.ids = []
+
+	def handle_starttag(self, tag, attrs):
+		line = self.getpos()[0]
+		attrs = dict([(k, v or '') for (k, v) in attrs])
+		if attrs.get('id'):
+			self.ids.append(attrs['id'])
+		if tag == 'model-viewer' and 'src' not in attrs and 'data-src' not in attrs:
+			self.links.append([line, tag, 'src', ''])
+		for url in CSS_URL.findall(attrs.get('style', '')):
+			self.links.append([line, tag, 'style', url.strip()])
+		for attr in CHECK_ATTRS:
+			if attr not in attrs:
+				continue
+			if attr == 'srcset':
+				for candidate in attrs[attr].split(','):
+					if candidate.strip():
+						self.links.append([line, tag, attr, candidate.split()[0]])
+			else:
+				self.links.append([line, tag, attr, attrs[attr].strip()])
+
+	handle_startendtag = handle_starttag
+
+def extract_links(path):
+	"""
+		Runs in the checker's process pool: returns (path, {'links': ..., 'ids': ...})
+	"""
+	with open(path, 'r', encoding = 'utf-8', errors = 'replace') as f:
+		parser = LinkReferences()
+		parser.feed(f.read())
+		parser.close()
+	return (path, {'links': parser.links, 'ids': parser.ids})
+
+def hash_file(path):
+	with open(path, 'rb') as f:
+		return hashlib.sha256(f.read()).hexdigest()
+
+def check_link(tag, attr, url, page, root, ids):
+	"""
+		Returns why the url is broken, or None.
+		`ids` maps checked files to their element ids, for fragments.
+	"""
+	if url == '':
+		#an empty href is a link to the page itself, like the series nav's current entry
+		if attr == 'href':
+			return None
+		return 'empty %s' % attr
+	if url == '#':
+		return 'placeholder link'
+	if not is_local_url(url):
+		if url.startswith('#') and url[1:] not in ids.get(page, []):
+			return 'no element with id "%s"' % url[1:]
+		return None
+
+	target = resolve_url(url, page, root)
+	if not os.path.isfile(target):
+		return 'missing %s' % os.path.relpath(target, root).replace(os.sep, '/')
+	fragment = urlsplit(url).fragment
+	if fragment and target in ids and fragment not in ids[target]:
+		return 'no element with id "%s" in %s' % (fragment, os.path.relpath(target, root).replace(os.sep, '/'))
+	return None
+
+def check_links(root, cache_path, jobs):
+	"""
+		Checks every html/xml file under `root`, returns [(file, line, tag, attribute, url, reason)].
+		Parse results are cached by file hash: only changed files are parsed again,
+		all links are resolved again since the files they point to may have changed.
+	"""
+	try:
+		with open(cache_path, 'r', encoding = 'utf-8') as f:
+			cache = json.load(f)
+	except (IOError, ValueError):
+		cache = {}
+
+	files = {}
+	for (dirpath, dirnames, filenames) in os.walk(root):
+		dirnames.sort()
+		for name in sorted(filenames):
+			if os.path.splitext(name)[1].lower() in CHECK_TYPES:
+				path = os.path.join(dirpath, name)
+				files[path] = hash_file(path)
+
+	parsed = {}
+	todo = []
+	for (path, digest) in files.items():
+		if digest in cache:
+			parsed[path] = cache[digest]
+		else:
+			todo.append(path)
+
+	context = fork_context()
+	if len(todo) > 1 and jobs > 1 and context != None:
+		import concurrent.futures
+		with concurrent.futures.ProcessPoolExecutor(max_workers = jobs, mp_context = context) as pool:
+			results = list(pool.map(extract_links, todo, chunksize = 8))
+	else:
+		results = [extract_links(path) for path in todo]
+	for (path, result) in results:
+		parsed[path] = result
+
+	ids = dict([(path, set(parsed[path]['ids'])) for path in parsed])
+	broken = []
+	for path in sorted(parsed.keys()):
+		for (line, tag, attr, url) in parsed[path]['links']:
+			reason = check_link(tag, attr, url, path, root, ids)
+			if reason != None:
+				broken.append((os.path.relpath(path, root).replace(os.sep, '/'), line, tag, attr, url, reason))
+
+	os.makedirs(os.path.dirname(cache_path), exist_ok = True)
+	with open(cache_path, 'w', encoding = 'utf-8') as f:
+		json.dump(dict([(files[path], parsed[path]) for path in sorted(parsed.keys())]), f, sort_keys = True)
+
+	Logs.pprint('CYAN', 'Checked %d files (%d parsed, %d from cache)' % (len(files), len(todo), len(files) - len(todo)))
+	return broken
+
+class CheckLinksContext(Build.BuildContext):
+	'''checks the links and assets of the static output (waf build checklinks)'''
+	cmd = 'checklinks'
+
+	def execute(self):
+		self.restore()
+		if not self.all_envs:
+			self.load_envs()
+		static_dir = self.bldnode.find_node('static')
+		if static_dir == None:
+			raise Errors.WafError('Nothing to check, build the site first')
+
+		broken = check_links(static_dir.abspath(), self.bldnode.make_node('check_links_cache.json').abspath(), Options.options.jobs)
+		for (path, line, tag, attr, url, reason) in broken:
+			Logs.error('%s:%d: <%s %s="%s">: %s' % (path, line, tag, attr, url, reason))
+		if len(broken) > 0:
+			raise Errors.WafError('%d broken links' % len(broken))
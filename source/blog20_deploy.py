@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+#deploy manifest: what changed in the static output since the last build
+
+from waflib import TaskGen, Logs, Options
+import os, json, hashlib
+
+def options(opt):
+	opt.add_option('--deploy-base', dest='deploy_base', type='string', default='', help='Manifest to compare the static output against, e.g. the one saved by the last deploy (default: the previous build\'s manifest)')
+
+def configure(conf):
+	conf.env.HAS_BLOG20_DEPLOY = True
+
+def hash_file(path):
+	h = hashlib.sha256()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(1 << 20), b''):
+			h.update(chunk)
+	return h.hexdigest()
+
+def read_manifest(path):
+	try:
+		with open(path, 'r', encoding = 'utf-8') as f:
+			return json.load(f)['files']
+	except (IOError, ValueError, KeyError):
+		return {}
+
+def scan_static(root, previous):
+	"""
+		Returns {relative path: {sha256, size, mtime}} for every file under `root`.
+		Hashes of files whose size and modification time didn't change are reused from `previous`.
+	"""
+	files = {}
+	for (dirpath, dirnames, filenames) in os.walk(root):
+		dirnames.sort()
+		for name in sorted(filenames):
+			path = os.path.join(dirpath, name)
+			rel = os.path.relpath(path, root).replace('\\', '/')
+			st = os.stat(path)
+			prev = previous.get(rel, None)
+			if prev != None and prev['size'] == st.st_size and prev.get('mtime') == st.st_mtime_ns:
+				digest = prev['sha256']
+			else:
+				digest = hash_file(path)
+			files[rel] = {'sha256': digest, 'size': st.st_size, 'mtime': st.st_mtime_ns}
+	return files
+
+def diff_manifests(old, new):
+	return {
+		'added': sorted([p for p in new if p not in old]),
+		'changed': sorted([p for p in new if p in old and new[p]['sha256'] != old[p]['sha256']]),
+		'removed': sorted([p for p in old if p not in new])
+	}
+
+def cdn_paths(paths):
+	"""
+		Urls to invalidate for the given files, directory urls are included for index pages
+	"""
+	urls = []
+	for p in paths:
+		urls.append('/' + p)
+		if p == 'index.html' or p.endswith('/index.html'):
+			urls.append('/' + p[:-len('index.html')])
+	return urls
+
+def write_deploy_manifest(bld, static_dir, outdir):
+	#the service worker is deployed too, write it first
+	if getattr(bld, 'write_service_worker', None) != None:
+		bld.write_service_worker(bld)
+
+	manifest = outdir.make_node('manifest.json')
+	previous = read_manifest(manifest.abspath())
+
+	base_path = getattr(Options.options, 'deploy_base', '')
+	base = read_manifest(base_path) if base_path else previous
+
+	files = scan_static(static_dir.abspath(), previous)
+	changes = diff_manifests(base, files)
+	changes['upload'] = changes['added'] + changes['changed']
+	changes['invalidate'] = cdn_paths(changes['changed'] + changes['removed'])
+	changes['upload_bytes'] = sum([files[p]['size'] for p in changes['upload']])
+
+	outdir.mkdir()
+	manifest.write(json.dumps({'files': files}, sort_keys = True, indent = 1), encoding = 'utf-8')
+	outdir.make_node('changes.json').write(json.dumps(changes, sort_keys = True, indent = 1), encoding = 'utf-8')
+
+	Logs.pprint('CYAN', 'Deploy manifest: %d added, %d changed, %d removed (%.1f KB to upload) -> %s' % (
+		len(changes['added']), len(changes['changed']), len(changes['removed']),
+		changes['upload_bytes'] / 1024.0, outdir.abspath()
+	))
+
+@TaskGen.feature("deploy_manifest")
+def proc_deploy_manifest(self):
+	"""
+		Once the build succeeds, writes build/deploy/manifest.json (hash and size of every file of the static directory)
+		and build/deploy/changes.json (added/changed/removed files, files to upload and urls to invalidate)
+	"""
+	static_dir = self.get_static_dir_root()
+	outdir = self.bld.bldnode.make_node(getattr(self, 'deploy_dir', 'deploy'))
+	self.bld.add_post_fun(lambda bld: write_deploy_manifest(bld, static_dir, outdir))
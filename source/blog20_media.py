@@ -2,6 +2,8 @@
 #miscellaneous media tools
 
 from waflib import Task, TaskGen, Errors
+from blog20 import extract_meta_header, write_if_changed
+import os, io, json, hashlib
 
 IMAGE_FORMATS = [
 	'.png','.bmp','.webp','.jpg','.jfif','.pjpeg','.pjp','.jpeg','.tiff', #'.gif', #breaks animations!
@@ -15,6 +17,7 @@ def options(opt):
 	opt.add_option('--img-shrink-maximum', dest='img_shrink_maxsize', type='int', default=512, help='Maximum allowed size in any dimension for images during shrinking (default: 512)')
 	opt.add_option('--img-convert-format', dest='img_convert_fmt', type='string', default="webp", help='output format during image conversions (default: "webp")')
 	opt.add_option('--snd-convert-format', dest='snd_convert_fmt', type='string', default="webp", help='output format during audio conversions (default: "mp3")')
+	opt.add_option('--no-thumbnail-atlas', dest='nothumbatlas', action="store_true", default=False, help="Don't pack index thumbnails into sprite sheets")
 
 def configure(conf):
 	#defaults
@@ -32,6 +35,7 @@ def configure(conf):
 	conf.env.HAS_BLOG20_MEDIA = True
 	conf.env.DISABLE_GIF_OPTIMIZATION = conf.options.nogifopt
 	conf.env.DISABLE_IMG_CONVERSION = conf.options.noimgconv
+	conf.env.DISABLE_THUMBNAIL_ATLAS = conf.options.nothumbatlas
 
 	#find required modules
 	failed = False
@@ -163,6 +167,129 @@ class ConvertImage(Task.Task):
 		new_im = Image.new('RGBA', (size, size), fill_color)
 		new_im.paste(im, (int((size - x) / 2), int((size - y) / 2)))
 		return new_im
+
+#transparent 1x1 gif, atlas tiles are drawn as the background of the <img>
+ATLAS_PLACEHOLDER = 'data:image/gif;base64,R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7'
+
+@TaskGen.feature("thumbnail_atlas")
+@TaskGen.after_method("proc_index")
+def proc_thumbnail_atlas(self):
+	"""
+		Packs the thumbnails of an index's items into WebP sprite sheets next to the index page,
+		GenerateIndex then draws each item's <img> from its sheet.
+		Thumbnails are the `atlas_field` metadata (default: 'tile') of the pages, relative to the task generator.
+			atlas_tile_width: width of the tiles in the sheets (default: 480)
+			atlas_columns: columns of tiles per sheet (default: 4)
+			atlas_tiles_per_sheet: (default: 16)
+			atlas_quality: WebP quality of the sheets (default: 80)
+	"""
+	if self.env.DISABLE_THUMBNAIL_ATLAS or getattr(self, 'index_page', None) == None:
+		return
+	field = getattr(self, 'atlas_field', 'tile')
+
+	mdts = list(getattr(self, 'mdout', []))
+	for usename in self.to_list(getattr(self, 'use', [])):
+		try:
+			mdts.extend(getattr(self.bld.get_tgen_by_name(usename), 'mdout', []))
+		except Errors.WafError:
+			continue
+
+	tiles = {}
+	for mdt in mdts:
+		src = mdt.inputs[0]
+		if src.suffix() == '.md_mv':
+			#the ModelViewerPreproc output is in the build directory, its source isn't
+			src = src.change_ext('.md').get_src()
+		if not os.path.isfile(src.abspath()):
+			continue
+		try:
+			(meta, _) = extract_meta_header(src)
+		except ValueError:
+			continue
+		if meta == None or not meta.get(field, ''):
+			continue
+		node = self.path.find_node(meta[field])
+		if node == None:
+			continue
+		converted = self.env.img_replacement_map.get(node.abspath(), None)
+		if converted != None:
+			node = self.bld.root.make_node(converted)
+		tiles[meta[field]] = node
+
+	if len(tiles) < 2:
+		return
+
+	keys = sorted(tiles.keys())
+	per_sheet = getattr(self, 'atlas_tiles_per_sheet', 16)
+	count = (len(keys) + per_sheet - 1) // per_sheet
+	sheets = [self.index_page.parent.find_or_declare('thumbnails-%d.webp' % i) for i in range(count)]
+	self.atlas_map = self.path.find_or_declare('tmp/atlas').find_or_declare(self.target + '.json')
+
+	tsk = self.create_task('BuildAtlas', [tiles[k] for k in keys], sheets + [self.atlas_map])
+	tsk.tiles = keys
+	tsk.per_sheet = per_sheet
+	tsk.tile_width = getattr(self, 'atlas_tile_width', 480)
+	tsk.columns = getattr(self, 'atlas_columns', 4)
+	tsk.quality = getattr(self, 'atlas_quality', 80)
+	tsk.urls = [s.path_from(self.index_page.parent).replace('\\', '/') for s in sheets]
+
+	for t in self.tasks:
+		if t.__class__.__name__ == 'GenerateIndex':
+			t.inputs.append(self.atlas_map)
+
+class BuildAtlas(Task.Task):
+	"""
+		Writes the sprite sheets and a json map {thumbnail: [sheet url, x, y, w, h, sheet w, sheet h]}.
+		Tiles are scaled to the tile width and stacked in the shortest column.
+	"""
+	before = ['GenerateIndex']
+
+	def sig_vars(self):
+		#the packing parameters are part of the signature, a different set of thumbnails makes different sheets
+		Task.Task.sig_vars(self)
+		self.m.update(repr((self.tiles, self.per_sheet, self.tile_width, self.columns, self.quality, self.urls)).encode('utf-8'))
+
+	def run(self):
+		from PIL import Image
+		w = self.tile_width
+		atlas = {}
+		for (i, url) in enumerate(self.urls):
+			chunk = list(range(i * self.per_sheet, min((i + 1) * self.per_sheet, len(self.tiles))))
+			columns = [0] * min(self.columns, len(chunk))
+			placed = []
+			for j in chunk:
+				img = Image.open(self.inputs[j].abspath()).convert('RGBA')
+				h = max(1, int(round(img.size[1] * float(w) / img.size[0])))
+				img = img.resize((w, h), Image.LANCZOS)
+				col = columns.index(min(columns))
+				placed.append((j, img, col * w, columns[col]))
+				columns[col] += h
+
+			sheet = Image.new('RGBA', (len(columns) * w, max(columns)), (0, 0, 0, 0))
+			for (j, img, x, y) in placed:
+				sheet.paste(img, (x, y))
+			buf = io.BytesIO()
+			sheet.save(buf, format = 'webp', quality = self.quality, method = 6)
+			data = buf.getvalue()
+			write_if_changed(self.outputs[i], data)
+
+			#fingerprint so browsers refetch a sheet only when it changes
+			versioned = '%s?v=%s' % (url, hashlib.sha1(data).hexdigest()[:10])
+			for (j, img, x, y) in placed:
+				atlas[self.tiles[j]] = [versioned, x, y, img.size[0], img.size[1], sheet.size[0], sheet.size[1]]
+
+		write_if_changed(self.outputs[-1], json.dumps(atlas, sort_keys = True), encoding = 'utf-8')
+
+def atlas_img_style(entry):
+	"""
+		Background drawing one tile of a sheet, in percentages so it scales with the <img> width
+	"""
+	(url, x, y, w, h, sw, sh) = entry
+	def pos(offset, size, total):
+		return 0 if total == size else 100.0 * offset / (total - size)
+	return 'background:url(%s) no-repeat;background-size:%g%% %g%%;background-position:%g%% %g%%;aspect-ratio:%d/%d' % (
+		url, 100.0 * sw / w, 100.0 * sh / h, pos(x, w, sw), pos(y, h, sh), w, h
+	)
 """
 class GenerateTTS(Task.Task):
 	def run(self):
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+#prebuilt client-side search index
+
+from waflib import Task, TaskGen
+from waflib.Errors import WafError
+from blog20 import extract_meta_header, parse_datestr, format_title, write_if_changed
+import json, re, os, html
+
+SEARCH_TAGS = re.compile(r'<[^>]*>')
+SEARCH_TERM = re.compile(r'\w+', re.UNICODE)
+SEARCH_STOPWORDS = set([
+	'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'from', 'has', 'have', 'i', 'if', 'in',
+	'into', 'is', 'it', 'its', 'of', 'on', 'or', 'so', 'that', 'the', 'this', 'to', 'was', 'were', 'with'
+])
+
+#term weights per field
+SEARCH_WEIGHTS = {'title': 8, 'description': 3, 'date': 2, 'body': 1}
+
+def options(opt):
+	opt.add_option('--search-shard-size', dest='search_shard_size', type='int', default=16384, help='Maximum size in bytes of a search index shard before it is split by longer prefixes (default: 16384)')
+	opt.add_option('--search-max-terms', dest='search_max_terms', type='int', default=400, help='Maximum number of indexed terms per document (default: 400)')
+
+def configure(conf):
+	conf.env.HAS_BLOG20_SEARCH = True
+	if conf.env.SEARCH_SHARD_SIZE == []:
+		conf.env.SEARCH_SHARD_SIZE = conf.options.search_shard_size
+	if conf.env.SEARCH_MAX_TERMS == []:
+		conf.env.SEARCH_MAX_TERMS = conf.options.search_max_terms
+
+def tokenize(text):
+	return [t for t in SEARCH_TERM.findall(text.lower()) if len(t) > 1 and t not in SEARCH_STOPWORDS]
+
+def shard_name(prefix):
+	#file name safe prefix: non ascii alphanumerics are written as -<hex codepoint>
+	return ''.join([c if c.isascii() and (c.isalnum() or c == '_') else '-%x' % ord(c) for c in prefix])
+
+def shard_terms(terms, prefix, max_bytes, shards):
+	"""
+		Splits a {term: postings} dict into shards keyed by term prefix.
+		A shard larger than `max_bytes` is split by one more character,
+		terms equal to the prefix itself stay in the prefix's shard.
+	"""
+	if len(json.dumps(terms, separators = (',', ':'))) <= max_bytes or all([len(t) <= len(prefix) for t in terms]):
+		shards[prefix] = terms
+		return
+
+	children = {}
+	for (term, postings) in terms.items():
+		if len(term) == len(prefix):
+			shards.setdefault(prefix, {})[term] = postings
+		else:
+			children.setdefault(term[len(prefix)], {})[term] = postings
+
+	for c in sorted(children.keys()):
+		shard_terms(children[c], prefix + c, max_bytes, shards)
+
+@TaskGen.feature("search_index")
+def proc_search_index(self):
+	"""
+		Builds a sharded inverted index of the pages of the task generators in `use`.
+		Each document is tokenized by its own task so only changed documents are re-indexed.
+	"""
+	root = self.get_static_dir_root()
+	tmpdir = self.path.find_or_declare("tmp/search")
+	doc_nodes = []
+
+	uselist = self.to_list(getattr(self, 'use', []))
+	for usename in uselist:
+		try:
+			tg = self.bld.get_tgen_by_name(usename)
+			tg.post()
+		except WafError:
+			continue
+
+		for gpt in [t for t in tg.tasks if t.__class__.__name__ == 'GeneratePageTemplate']:
+			published = [t for t in tg.tasks if t is not gpt and len(t.inputs) > 0 and t.inputs[0] == gpt.outputs[0]]
+			if len(published) == 0:
+				continue
+			md = gpt.mdt
+			outnode = tmpdir.find_or_declare(usename).find_or_declare(md.outputs[0].name + '.terms.json')
+			tsk = self.create_task('IndexSearchDocument', [md.outputs[0], md.inputs[0]], [outnode])
+			tsk.url = '/' + published[0].outputs[0].path_from(root).replace('\\', '/')
+			doc_nodes.append(outnode)
+
+	outdir = self.get_static_dir().find_or_declare(self.target)
+	self.create_task('MergeSearchIndex', doc_nodes, [outdir.find_or_declare('index.json')])
+
+class IndexSearchDocument(Task.Task):
+	"""
+		Writes the weighted terms of a single document
+	"""
+	after = ['BuildMdContent']
+	vars = ['SEARCH_MAX_TERMS']
+
+	def sig_vars(self):
+		Task.Task.sig_vars(self)
+		self.m.update(self.url.encode('utf-8'))
+
+	def run(self):
+		(meta, _) = extract_meta_header(self.inputs[1])
+		if meta == None:
+			meta = {}
+
+		body = html.unescape(SEARCH_TAGS.sub(' ', self.inputs[0].read(encoding = 'utf-8')))
+		title = format_title(meta.get('title', self.inputs[1].change_ext('').name))
+		description = meta.get('description', '')
+
+		date = ''
+		date_text = ''
+		if 'date' in meta:
+			d = parse_datestr(meta['date'])
+			date = d.strftime('%Y-%m-%d')
+			date_text = '%s %s' % (date, d.strftime('%B %Y'))
+
+		terms = {}
+		for (field, text) in [('title', title), ('description', description), ('date', date_text), ('body', body)]:
+			for t in tokenize(text):
+				terms[t] = terms.get(t, 0) + SEARCH_WEIGHTS[field]
+
+		#size bound: keep the highest scoring terms
+		kept = sorted(terms.items(), key = lambda t: (-t[1], t[0]))[:int(self.env.SEARCH_MAX_TERMS or 400)]
+
+		self.outputs[0].parent.mkdir()
+		write_if_changed(self.outputs[0], json.dumps({
+			'url': self.url,
+			'title': title,
+			'description': description,
+			'date': date,
+			'terms': dict(kept)
+		}, sort_keys = True), encoding = 'utf-8')
+
+class MergeSearchIndex(Task.Task):
+	"""
+		Merges the per-document terms into index.json (documents and shard table)
+		and one shard_<prefix>.json per term prefix next to it
+	"""
+	vars = ['SEARCH_SHARD_SIZE']
+
+	def run(self):
+		docs = []
+		terms = {}
+		for node in sorted(self.inputs, key = lambda n: n.abspath()):
+			doc = json.loads(node.read(encoding = 'utf-8'))
+			docid = len(docs)
+			docs.append([doc['url'], doc['title'], doc['description'], doc['date']])
+			for (term, score) in doc['terms'].items():
+				terms.setdefault(term, []).extend([docid, score])
+
+		shards = {}
+		shard_terms(terms, '', int(self.env.SEARCH_SHARD_SIZE or 16384), shards)
+
+		outdir = self.outputs[0].parent
+		outdir.mkdir()
+		shard_files = {}
+		for prefix in sorted(shards.keys()):
+			name = 'shard_%s.json' % shard_name(prefix)
+			write_if_changed(outdir.make_node(name), json.dumps(shards[prefix], sort_keys = True, separators = (',', ':')), encoding = 'utf-8')
+			shard_files[prefix] = name
+
+		#remove shards left over from a previous layout
+		for name in os.listdir(outdir.abspath()):
+			if name.startswith('shard_') and name not in shard_files.values():
+				os.remove(os.path.join(outdir.abspath(), name))
+
+		write_if_changed(self.outputs[0], json.dumps({
+			'version': 1,
+			'docs': docs,
+			'shards': shard_files
+		}, sort_keys = True, separators = (',', ':')), encoding = 'utf-8')
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+#service worker: precached shell and revisioned runtime caches
+
+from waflib import TaskGen, Logs
+from blog20 import write_if_changed
+from blog20_deploy import scan_static, read_manifest
+from blog20_check import PageWeigher
+from string import Template
+import os, json, hashlib
+
+#assets referenced by pages that are precached when the worker installs
+SHELL_TYPES = ['.css', '.js', '.woff2', '.woff', '.ttf']
+
+#files never handled by the worker
+SW_EXCLUDE = ['.map']
+
+def options(opt):
+	opt.add_option('--no-service-worker', dest='no_service_worker', action="store_true", default=False, help="Don't generate a service worker and don't register it in pages")
+
+def configure(conf):
+	conf.env.HAS_BLOG20_SERVICEWORKER = True
+	conf.env.SERVICE_WORKER = '' if conf.options.no_service_worker else '/sw.js'
+
+def site_revisions(files, exclude):
+	"""
+		Maps the url path of every file to a revision derived from its content hash,
+		index pages are also reachable by their directory url
+	"""
+	revisions = {}
+	for (rel, info) in files.items():
+		if rel in exclude or os.path.splitext(rel)[1] in SW_EXCLUDE:
+			continue
+		revisions['/' + rel] = info['sha256'][:12]
+		if rel == 'index.html' or rel.endswith('/index.html'):
+			revisions['/' + rel[:-len('index.html')]] = info['sha256'][:12]
+	return revisions
+
+def shell_assets(root, revisions):
+	"""
+		Stylesheets, scripts and fonts fetched by the pages of the site,
+		conditional includes for old browsers and unused font formats aren't precached
+	"""
+	weigher = PageWeigher(root)
+	paths = set()
+	for page in [p for p in revisions.keys() if p.endswith('.html')]:
+		(resources, external) = weigher.resources(os.path.join(root, page.lstrip('/')))
+		for r in resources:
+			if os.path.splitext(r)[1] in SHELL_TYPES:
+				paths.add('/' + os.path.relpath(r, root).replace(os.sep, '/'))
+	return [[p, revisions[p]] for p in sorted(paths) if p in revisions]
+
+def write_service_worker(bld, static_dir, statedir, template):
+	name = bld.env.SERVICE_WORKER.lstrip('/')
+	state = statedir.make_node('files.json')
+
+	files = scan_static(static_dir.abspath(), read_manifest(state.abspath()))
+	revisions = site_revisions(files, [name])
+	precache = shell_assets(static_dir.abspath(), revisions)
+	#the worker changes, and browsers update it, whenever any file of the site changes
+	version = hashlib.sha256(json.dumps(revisions, sort_keys = True).encode('utf-8')).hexdigest()[:12]
+
+	with open(template, 'r', encoding = 'utf-8') as f:
+		src = Template(f.read()).substitute({
+			'version': version,
+			'precache': json.dumps(precache, indent = 1),
+			'revisions': json.dumps(revisions, sort_keys = True, indent = 1)
+		})
+
+	statedir.mkdir()
+	state.write(json.dumps({'files': files}, sort_keys = True), encoding = 'utf-8')
+	if write_if_changed(static_dir.make_node(name), src, encoding = 'utf-8'):
+		Logs.pprint('CYAN', 'Service worker %s: version %s, %d shell assets precached, %d files revisioned' % (
+			bld.env.SERVICE_WORKER, version, len(precache), len(revisions)
+		))
+
+@TaskGen.feature("service_worker")
+def proc_service_worker(self):
+	"""
+		Once the build succeeds, writes the service worker registered by pages (/sw.js) from the content hashes of the static directory.
+		Pages only register it when a task generator has this feature.
+		The deploy manifest calls bld.write_service_worker before scanning, so it sees the new worker.
+			sw_template: worker template (default: tpl_service_worker.js next to this tool)
+	"""
+	if not self.env.SERVICE_WORKER:
+		return
+	static_dir = self.get_static_dir_root()
+	statedir = self.bld.bldnode.make_node('service_worker')
+	template = getattr(self, 'sw_template', None)
+	if template != None:
+		template = self.to_nodes(template)[0].abspath()
+	else:
+		template = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tpl_service_worker.js')
+
+	def write(bld):
+		if not getattr(bld, 'service_worker_written', False):
+			bld.service_worker_written = True
+			write_service_worker(bld, static_dir, statedir, template)
+	self.bld.write_service_worker = write
+	self.bld.add_post_fun(write)
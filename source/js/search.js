@@ -0,0 +1,128 @@
+/*
+	Client side search over the sharded index written by the search_index build feature.
+	Only index.json and the shards matching the query terms are downloaded.
+
+	blogSearch.query('some words', function(results) { ... });
+*/
+var blogSearch = (function() {
+
+	var	search = {
+			url: '/search/index.json'
+		},
+		index = null,
+		shards = {},
+		stopwords = ['a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'from', 'has', 'have', 'i', 'if', 'in',
+			'into', 'is', 'it', 'its', 'of', 'on', 'or', 'so', 'that', 'the', 'this', 'to', 'was', 'were', 'with'];
+
+	function getJSON(url, callback) {
+		var xhr = new XMLHttpRequest();
+		xhr.open('GET', url);
+		xhr.onload = function() {
+			callback(xhr.status == 200 ? JSON.parse(xhr.responseText) : null);
+		};
+		xhr.send();
+	}
+
+	function tokenize(text) {
+		return (text.toLowerCase().match(/[\p{L}\p{N}_]+/gu) || []).filter(function(t) {
+			return t.length > 1 && stopwords.indexOf(t) < 0;
+		});
+	}
+
+	// Shards holding a term: the longest shard prefix of the term and, for prefix matching,
+	// the shards it was split into (prefixes starting with the term)
+	function shardsFor(term, asPrefix) {
+		var best = null,
+			prefixes = [];
+		for (var prefix in index.shards) {
+			if (term.indexOf(prefix) == 0 && (best === null || prefix.length > best.length))
+				best = prefix;
+			else if (asPrefix && prefix.length > term.length && prefix.indexOf(term) == 0)
+				prefixes.push(prefix);
+		}
+		if (best !== null)
+			prefixes.push(best);
+		return prefixes;
+	}
+
+	function loadShard(prefix, callback) {
+		if (prefix in shards)
+			return callback(shards[prefix]);
+		var base = search.url.substring(0, search.url.lastIndexOf('/') + 1);
+		getJSON(base + index.shards[prefix], function(shard) {
+			shards[prefix] = shard || {};
+			callback(shards[prefix]);
+		});
+	}
+
+	function loadShards(prefixes, callback) {
+		var pending = prefixes.length,
+			loaded = [];
+		prefixes.forEach(function(prefix) {
+			loadShard(prefix, function(shard) {
+				loaded.push(shard);
+				if (--pending == 0) callback(loaded);
+			});
+		});
+	}
+
+	function run(terms, callback) {
+		var pending = terms.length,
+			matches = [];
+
+		if (pending == 0)
+			return callback([]);
+
+		terms.forEach(function(term, i) {
+			// The last term is matched as a prefix while typing.
+			var asPrefix = (i == terms.length - 1),
+				prefixes = shardsFor(term, asPrefix);
+			if (prefixes.length == 0) {
+				matches[i] = {};
+				if (--pending == 0) done();
+				return;
+			}
+			loadShards(prefixes, function(loaded) {
+				var scores = {};
+				loaded.forEach(function(shard) {
+					for (var t in shard) {
+						if (t != term && (!asPrefix || t.indexOf(term) != 0))
+							continue;
+						for (var j = 0; j < shard[t].length; j += 2)
+							scores[shard[t][j]] = (scores[shard[t][j]] || 0) + shard[t][j + 1];
+					}
+				});
+				matches[i] = scores;
+				if (--pending == 0) done();
+			});
+		});
+
+		function done() {
+			var results = [];
+			for (var docid in matches[0]) {
+				var score = 0;
+				for (var i = 0; i < matches.length && score >= 0; i++)
+					score = (docid in matches[i]) ? score + matches[i][docid] : -1;
+				if (score < 0)
+					continue;
+				var doc = index.docs[docid];
+				results.push({ url: doc[0], title: doc[1], description: doc[2], date: doc[3], score: score });
+			}
+			results.sort(function(a, b) { return b.score - a.score; });
+			callback(results);
+		}
+	}
+
+	search.query = function(text, callback) {
+		var terms = tokenize(text);
+		if (index !== null)
+			return run(terms, callback);
+		getJSON(search.url, function(data) {
+			index = data || { docs: [], shards: {} };
+			run(terms, callback);
+		});
+	};
+
+	return search;
+
+})();
@@ -0,0 +1,143 @@
+//generated by blog20_serviceworker: $version
+'use strict';
+
+//[path, revision] of the shell assets installed with the worker
+var PRECACHE = $precache;
+//content revision of every file of the site, cached responses are used while their revision is current
+var REVISIONS = $revisions;
+
+var CACHE_SHELL = 'blog20-shell';
+var CACHE_PAGES = 'blog20-pages';
+var CACHE_MEDIA = 'blog20-media';
+var MEDIA = /\.(webp|png|jpe?g|gif|svg|ico|avif|glb|gltf|bin|mp4|webm|mp3)$$/i;
+
+var SHELL = {};
+PRECACHE.forEach(function(entry) { SHELL[entry[0]] = true; });
+
+function revisionKey(path, rev) {
+	return path + '?__rev=' + rev;
+}
+
+function keyRevision(request) {
+	var url = new URL(request.url);
+	return [url.pathname, url.searchParams.get('__rev')];
+}
+
+//deletes the entries of files removed from the site, and older revisions of files whose current revision is cached:
+//until then the newest older revision is kept as the offline copy
+function prune(cacheName) {
+	return caches.open(cacheName).then(function(cache) {
+		return cache.keys().then(function(requests) {
+			var current = {};
+			requests.forEach(function(r) {
+				var pr = keyRevision(r);
+				if (REVISIONS[pr[0]] === pr[1]) {
+					current[pr[0]] = true;
+				}
+			});
+			var older = {};
+			requests.forEach(function(r) {
+				var pr = keyRevision(r);
+				if (REVISIONS[pr[0]] !== undefined && REVISIONS[pr[0]] !== pr[1] && !current[pr[0]]) {
+					//keys are in insertion order, the last one is the newest
+					older[pr[0]] = r.url;
+				}
+			});
+			return Promise.all(requests.filter(function(r) {
+				var pr = keyRevision(r);
+				return REVISIONS[pr[0]] !== pr[1] && older[pr[0]] !== r.url;
+			}).map(function(r) {
+				return cache.delete(r);
+			}));
+		});
+	});
+}
+
+function dropOlder(cache, path, key) {
+	return cache.keys().then(function(requests) {
+		return Promise.all(requests.filter(function(r) {
+			return keyRevision(r)[0] === path && r.url !== new URL(key, self.location).href;
+		}).map(function(r) {
+			return cache.delete(r);
+		}));
+	});
+}
+
+function fromCache(cacheName, path, rev, request) {
+	var key = revisionKey(path, rev);
+	return caches.open(cacheName).then(function(cache) {
+		return cache.match(key).then(function(hit) {
+			if (hit) {
+				return hit;
+			}
+			return fetch(request).then(function(response) {
+				if (response.status === 200 && !response.redirected) {
+					cache.put(key, response.clone()).then(function() {
+						return dropOlder(cache, path, key);
+					});
+				}
+				return response;
+			}).catch(function(err) {
+				//offline and this revision was never cached: an older copy is better than nothing
+				return cache.match(path, {ignoreSearch: true}).then(function(old) {
+					if (old) {
+						return old;
+					}
+					throw err;
+				});
+			});
+		});
+	});
+}
+
+self.addEventListener('install', function(event) {
+	//shell assets whose revision is already cached aren't downloaded again
+	event.waitUntil(caches.open(CACHE_SHELL).then(function(cache) {
+		return Promise.all(PRECACHE.map(function(entry) {
+			var key = revisionKey(entry[0], entry[1]);
+			return cache.match(key).then(function(hit) {
+				if (hit) {
+					return;
+				}
+				return fetch(entry[0], {cache: 'no-cache'}).then(function(response) {
+					if (!response.ok) {
+						throw new Error('precache failed: ' + entry[0]);
+					}
+					return cache.put(key, response);
+				});
+			});
+		}));
+	}).then(function() {
+		return self.skipWaiting();
+	}));
+});
+
+self.addEventListener('activate', function(event) {
+	event.waitUntil(Promise.all([prune(CACHE_SHELL), prune(CACHE_PAGES), prune(CACHE_MEDIA)]).then(function() {
+		return self.clients.claim();
+	}));
+});
+
+self.addEventListener('fetch', function(event) {
+	var request = event.request;
+	if (request.method !== 'GET') {
+		return;
+	}
+	var url = new URL(request.url);
+	var rev = REVISIONS[url.pathname];
+	if (url.origin !== self.location.origin || rev === undefined) {
+		return;
+	}
+
+	var cacheName;
+	if (SHELL[url.pathname]) {
+		cacheName = CACHE_SHELL;
+	} else if (request.mode === 'navigate' || /(\.html|\/)$$/.test(url.pathname)) {
+		cacheName = CACHE_PAGES;
+	} else if (MEDIA.test(url.pathname)) {
+		cacheName = CACHE_MEDIA;
+	} else {
+		return;
+	}
+	event.respondWith(fromCache(cacheName, url.pathname, rev, request));
+});